@@ -39,10 +39,17 @@ if "HYPHE_DOWNLOAD_DELAY"       in environ: setConfig("download_delay", float(en
 if "HYPHE_STORE_CRAWLED_HTML"   in environ: setConfig("store_crawled_html_content", strToBool(environ["HYPHE_STORE_CRAWLED_HTML"]),configdata,"mongo-scrapy")
 if "HYPHE_MAX_SIM_REQ"          in environ: setConfig("max_simul_requests", int(environ["HYPHE_MAX_SIM_REQ"]),configdata,"mongo-scrapy")
 if "HYPHE_HOST_MAX_SIM_REQ"     in environ: setConfig("max_simul_requests_per_host", int(environ["HYPHE_HOST_MAX_SIM_REQ"]),configdata,"mongo-scrapy")
+if "HYPHE_MAX_QUEUED_PAGES"     in environ: setConfig("max_queued_pages", int(environ["HYPHE_MAX_QUEUED_PAGES"]),configdata,"mongo-scrapy")
 
 if "HYPHE_TRAPH_KEEPALIVE"      in environ: setConfig("keepalive", int(environ["HYPHE_TRAPH_KEEPALIVE"]),configdata,"traph")
 if "HYPHE_TRAPH_DATAPATH"       in environ: setConfig("data_path", environ["HYPHE_TRAPH_DATAPATH"],configdata,"traph")
 if "HYPHE_TRAPH_MAX_SIM_PAGES"  in environ: setConfig("max_simul_pages_indexing", int(environ["HYPHE_TRAPH_MAX_SIM_PAGES"]),configdata,"traph")
+if "HYPHE_TRAPH_QUERY_TIMEOUT"  in environ: setConfig("query_timeout", int(environ["HYPHE_TRAPH_QUERY_TIMEOUT"]),configdata,"traph")
+if "HYPHE_TRAPH_POOL_SIZE"      in environ: setConfig("pool_size", int(environ["HYPHE_TRAPH_POOL_SIZE"]),configdata,"traph")
+if "HYPHE_TRAPH_MAX_RAM"        in environ: setConfig("max_ram", int(environ["HYPHE_TRAPH_MAX_RAM"]),configdata,"traph")
+if "HYPHE_TRAPH_REPLICAS"       in environ: setConfig("replicas", int(environ["HYPHE_TRAPH_REPLICAS"]),configdata,"traph")
+if "HYPHE_TRAPH_ITER_SLICE"     in environ: setConfig("iteration_slice", int(environ["HYPHE_TRAPH_ITER_SLICE"]),configdata,"traph")
+if "HYPHE_TRAPH_BATCH_DURATION" in environ: setConfig("batch_duration", int(environ["HYPHE_TRAPH_BATCH_DURATION"]),configdata,"traph")
 
 if "HYPHE_DEFAULT_STARTPAGES_MODE"  in environ: setConfig("defaultStartpagesMode", literal_eval(environ["HYPHE_DEFAULT_STARTPAGES_MODE"]),configdata)
 if "HYPHE_DEFAULT_CREATION_RULE"    in environ: setConfig("defaultCreationRule", environ["HYPHE_DEFAULT_CREATION_RULE"],configdata)
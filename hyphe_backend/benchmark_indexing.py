@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+helpdoc="""
+Benchmark of the indexing path: replays crawled pages through the core's
+Memory_Structure.index_batch into a real traph process, using the local
+MongoDB configured for Hyphe within a throwaway corpus, then reports
+pages/s, links/s, batches latencies and peak memory.
+Pages are either recorded ones, read from a file of JSON documents in the
+crawler's Page item format (one per line, as exported with
+« mongoexport -d hyphe_CORPUS -c queue »), or generated synthetically.
+Examples from HCI root:
+python hyphe_backend/benchmark_indexing.py
+python hyphe_backend/benchmark_indexing.py --pages 100000 --hosts 500 --links 80
+python hyphe_backend/benchmark_indexing.py --input queue.json --repeat 3
+"""
+
+import os, sys, time, json, resource
+from random import Random
+from shutil import rmtree
+from tempfile import mkdtemp
+from argparse import ArgumentParser, RawDescriptionHelpFormatter
+from twisted.internet import reactor
+from twisted.internet.defer import succeed, inlineCallbacks
+from twisted.python import log as logger
+
+parser = ArgumentParser(description=helpdoc, formatter_class=RawDescriptionHelpFormatter)
+parser.add_argument("--input", help="file of recorded pages as JSON documents, one per line (generates synthetic pages otherwise)")
+parser.add_argument("--repeat", type=int, default=1, help="number of times to replay recorded pages (default: 1)")
+parser.add_argument("--pages", type=int, default=20000, help="number of synthetic pages to generate (default: 20000)")
+parser.add_argument("--hosts", type=int, default=200, help="number of hosts for synthetic pages (default: 200)")
+parser.add_argument("--links", type=int, default=50, help="average number of links per synthetic page (default: 50)")
+parser.add_argument("--menu", type=int, default=20, help="number of navigation links repeated on all synthetic pages of a host (default: 20)")
+parser.add_argument("--seed", type=int, default=0, help="random seed for synthetic pages (default: 0)")
+parser.add_argument("--verbose", action="store_true", help="display the core's and traph's logs")
+args = parser.parse_args()
+
+# Load the core's classes without starting its API and self tests
+with open(os.path.join("hyphe_backend", "core.tac")) as f:
+    core_source = f.read().split("\n# TEST API\n")[0]
+hyphe = {"__name__": "hyphe_benchmark", "__file__": os.path.join("hyphe_backend", "core.tac")}
+exec(compile(core_source, hyphe["__file__"], "exec"), hyphe)
+config = hyphe["config"]
+urllru = hyphe["urllru"]
+is_error = hyphe["is_error"]
+now_ts = hyphe["now_ts"]
+deferredSleep = hyphe["deferredSleep"]
+
+BENCHMARK_CORPUS = "--benchmark-%s--" % os.getpid()
+
+
+def synthetic_pages(n_pages, n_hosts, n_links, n_menu, seed=0):
+    rand = Random(seed)
+    host_lru = lambda h: "s:http|h:com|h:site%s|h:www|" % h
+    for i in xrange(n_pages):
+        host = rand.randint(0, n_hosts - 1)
+        lru = "%sp:section%s|p:page%s|" % (host_lru(host), i % 10, i)
+        links = ["%sp:menu%s|" % (host_lru(host), m) for m in xrange(n_menu)]
+        for _ in xrange(max(0, int(rand.gauss(n_links, n_links / 3.)) - n_menu)):
+            target = host if rand.random() < 0.7 else rand.randint(0, n_hosts - 1)
+            links.append("%sp:section%s|p:page%s|" % (host_lru(target), rand.randint(0, 9), rand.randint(0, n_pages)))
+        yield {
+          "url": urllru.lru_to_url(lru),
+          "lru": lru,
+          "status": 200,
+          "timestamp": now_ts(),
+          "size": 1000,
+          "encoding": "utf-8",
+          "depth": 1,
+          "content_type": "text/html",
+          "lrulinks": links
+        }
+
+def recorded_pages(path, repeat=1):
+    for _ in xrange(repeat):
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                page = json.loads(line)
+                page.pop("_id", None)
+                page.pop("_job", None)
+                page["timestamp"] = now_ts()
+                yield page
+
+def percentile(values, pct):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100. * (len(values) - 1))))]
+
+def peak_memory(pid):
+    try:
+        with open("/proc/%s/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except (IOError, ValueError):
+        pass
+    return 0
+
+
+class ReplayQueue(object):
+    # Stand-in for the crawl jobs queue the indexer reports to
+
+    def __init__(self):
+        self.indexed = 0
+
+    def report_indexed(self, corpus, nb_pages):
+        self.indexed += nb_pages
+
+
+class ReplayCrawler(object):
+
+    def __init__(self):
+        self.crawlqueue = ReplayQueue()
+
+
+class BenchmarkCore(hyphe["Core"]):
+    # Core limited to what indexing requires: MongoDB, traphs and the
+    # Memory_Structure, without crawler, API nor monitoring loops
+
+    def __init__(self, data_dir):
+        self.db = hyphe["MongoDB"](config['mongo-scrapy'])
+        self.traphs = hyphe["TraphFactory"](data_dir=data_dir, query_timeout=0, pool_size=0, max_ram=0, replicas=0, iteration_slice=config["traph"]["iteration_slice"], chatty=args.verbose)
+        self.corpora = {}
+        self.destroying = {}
+        self.crawler = ReplayCrawler()
+        self.store = hyphe["Memory_Structure"](self)
+
+    def update_corpus(self, *args, **kwargs):
+        return succeed(None)
+
+
+@inlineCallbacks
+def run_benchmark(core, corpus, pages):
+    core.init_corpus(corpus)
+    yield core.db.init_corpus_indexes(corpus)
+    core.traphs.start_corpus(corpus, quiet=not args.verbose, keepalive=3600, default_WECR=hyphe["getWECR"](config['defaultCreationRule']))
+    while not core.traphs.test_corpus(corpus):
+        if core.traphs.status_corpus(corpus) == "error":
+            raise Exception("Could not start traph: %s" % core.traphs.corpora[corpus].error)
+        yield deferredSleep(0.1)
+
+    # Fill the queue collection as the crawler would
+    s = time.time()
+    n_pages = 0
+    n_links = 0
+    chunk = []
+    for page in pages:
+        page["_job"] = "benchmark"
+        n_pages += 1
+        n_links += len(page.get("lrulinks", []))
+        chunk.append(page)
+        if len(chunk) == 1000:
+            yield core.db.queue(corpus).insert(chunk, safe=True)
+            chunk = []
+    if chunk:
+        yield core.db.queue(corpus).insert(chunk, safe=True)
+    print "%s pages with %s links queued in MongoDB in %.2fs" % (n_pages, n_links, time.time() - s)
+
+    # Index them batch after batch as index_batch_loop does
+    job = {'_id': 'unknown', 'crawljob_id': 'benchmark', 'webentity_id': None}
+    latencies = []
+    sizes = []
+    writes = succeed(None)
+    indexing_ids = set()
+    s = time.time()
+    while True:
+        specs = {'_job': 'benchmark'}
+        if indexing_ids:
+            specs['_id'] = {'$nin': list(indexing_ids)}
+        page_items = yield core.db.get_queue(corpus, specs, limit=core.corpora[corpus]['index_batch']['size'])
+        if not page_items:
+            break
+        indexing_ids.update(p['_id'] for p in page_items)
+        batch_start = time.time()
+        res = yield core.store.index_batch(page_items, job, corpus=corpus, writes=writes, indexing_ids=indexing_ids)
+        if is_error(res):
+            raise Exception(res['message'])
+        latencies.append(time.time() - batch_start)
+        sizes.append(len(page_items))
+    yield writes
+    duration = time.time() - s
+
+    print "%s batches of %s pages on average indexed in %.2fs" % (len(sizes), sum(sizes) / max(1, len(sizes)), duration)
+    print "  pages/s:          %.1f" % (n_pages / duration)
+    print "  links/s:          %.1f" % (n_links / duration)
+    print "  batch p50:        %.3fs" % percentile(latencies, 50)
+    print "  batch p99:        %.3fs" % percentile(latencies, 99)
+    print "  webentities:      %s" % core.corpora[corpus]['total_webentities']
+    print "  webentity links:  %s" % sum(len(sources) for sources in core.corpora[corpus]['webentities_links'].values())
+    print "  peak RSS core:    %sMo" % (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+    print "  peak RSS traph:   %sMo" % peak_memory(core.traphs.corpora[corpus].transport.pid)
+
+@inlineCallbacks
+def main():
+    data_dir = mkdtemp(prefix="hyphe-benchmark-")
+    core = BenchmarkCore(data_dir)
+    if args.input:
+        pages = recorded_pages(args.input, args.repeat)
+    else:
+        pages = synthetic_pages(args.pages, args.hosts, args.links, args.menu, args.seed)
+    try:
+        yield run_benchmark(core, BENCHMARK_CORPUS, pages)
+    except Exception as e:
+        print " !! ERROR: ", e
+    finally:
+        yield core.traphs.stop_corpus(BENCHMARK_CORPUS, True)
+        yield core.db.delete_corpus(BENCHMARK_CORPUS)
+        rmtree(data_dir, ignore_errors=True)
+        reactor.stop()
+
+if __name__ == "__main__":
+    if args.verbose:
+        logger.startLogging(sys.stdout)
+    reactor.callWhenRunning(main)
+    reactor.run()
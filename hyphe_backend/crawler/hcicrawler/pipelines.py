@@ -19,11 +19,12 @@ class RemoveBody(object):
 
 class MongoOutput(object):
 
-    def __init__(self, host, port, db, queue_col, page_col, jobid):
+    def __init__(self, host, port, db, queue_col, page_col, jobs_col, jobid):
         store = MongoConnection(host, port)[db]
         self.jobid = jobid
         self.pageStore = store[page_col]
         self.queueStore = store[queue_col]
+        self.jobsStore = store[jobs_col]
         self.queueStore.create_index(mongosort(ASCENDING('_job')))
 
     @classmethod
@@ -33,8 +34,9 @@ class MongoOutput(object):
         db = crawler.settings['MONGO_DB']
         queue_col = crawler.settings['MONGO_QUEUE_COL']
         page_col = crawler.settings['MONGO_PAGESTORE_COL']
+        jobs_col = crawler.settings.get('MONGO_JOBS_COL', 'jobs')
         jobid = crawler.settings['JOBID']
-        return cls(host, port, db, queue_col, page_col, jobid)
+        return cls(host, port, db, queue_col, page_col, jobs_col, jobid)
 
 
 class OutputQueue(MongoOutput):
@@ -44,6 +46,9 @@ class OutputQueue(MongoOutput):
         d = dict(item)
         d['_job'] = self.jobid
         yield self.queueStore.insert(d, safe=True)
+        # Maintain the job's pages counters, the core only reconciles them
+        # with the actual pages and queue collections once in a while
+        yield self.jobsStore.update({'crawljob_id': self.jobid}, {'$inc': {'nb_crawled_pages': 1, 'nb_unindexed_pages': 1}}, safe=True)
         returnValue(item)
 
 class OutputStore(MongoOutput):
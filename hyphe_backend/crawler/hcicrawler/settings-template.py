@@ -37,6 +37,7 @@ MONGO_PORT = {{mongo_port}}
 MONGO_DB = '{{db_name}}_{{project}}'
 MONGO_QUEUE_COL = 'queue'
 MONGO_PAGESTORE_COL = 'pages'
+MONGO_JOBS_COL = 'jobs'
 
 PHANTOM = {
   "PATH": os.path.join('{{hyphePath}}', 'bin', 'hyphe-phantomjs-2.0.0'),
@@ -41,6 +41,8 @@ def load_config():
         }
         if 'store_crawled_html_content' not in conf['mongo-scrapy']:
             conf['mongo-scrapy']['store_crawled_html_content'] = True
+        if 'max_queued_pages' not in conf['mongo-scrapy']:
+            conf['mongo-scrapy']['max_queued_pages'] = 100000
 
   # Set default creation rules if missing
     if "defaultCreationRule" not in conf:
@@ -48,6 +50,21 @@ def load_config():
     if "creationRules" not in conf:
         conf["creationRules"] = {}
 
+  # Set default traph advanced settings if missing
+    if "traph" in conf:
+        if "query_timeout" not in conf["traph"]:
+            conf["traph"]["query_timeout"] = 300
+        if "pool_size" not in conf["traph"]:
+            conf["traph"]["pool_size"] = 1
+        if "max_ram" not in conf["traph"]:
+            conf["traph"]["max_ram"] = 0
+        if "replicas" not in conf["traph"]:
+            conf["traph"]["replicas"] = 0
+        if "iteration_slice" not in conf["traph"]:
+            conf["traph"]["iteration_slice"] = 50
+        if "batch_duration" not in conf["traph"]:
+            conf["traph"]["batch_duration"] = 3
+
   # Auto unset phantomJs autoretry if missing
     if "phantom" in conf and "autoretry" not in conf["phantom"]:
         conf["phantom"]["autoretry"] = False
@@ -92,7 +109,7 @@ def validateStartpagesMode(modes):
 GLOBAL_CONF_SCHEMA = {
   "mongo-scrapy": {
     "type": dict,
-    "int_fields": ["mongo_port", "proxy_port", "scrapy_port", "max_depth", "max_simul_requests", "max_simul_requests_per_host"],
+    "int_fields": ["mongo_port", "proxy_port", "scrapy_port", "max_depth", "max_simul_requests", "max_simul_requests_per_host", "max_queued_pages"],
     "str_fields": ["host", "proxy_host", "db_name"],
     "extra_fields": {
       "download_delay": float,
@@ -100,7 +117,7 @@ GLOBAL_CONF_SCHEMA = {
     }
   }, "traph": {
     "type": dict,
-    "int_fields": ["keepalive", "max_simul_pages_indexing"],
+    "int_fields": ["keepalive", "max_simul_pages_indexing", "query_timeout", "pool_size", "max_ram", "replicas", "iteration_slice", "batch_duration"],
     "extra_fields": {
       "data_path": "path"
     }
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from zope.interface import implementer
+from twisted.python import log as logger
+from twisted.internet.defer import Deferred, inlineCallbacks, returnValue as returnD
+from twisted.internet.interfaces import IPushProducer
+
+@implementer(IPushProducer)
+class ExportProducer(object):
+    # Writes the batches of an export as the client consumes them, pausing
+    # while the request's transport buffer is full
+
+    def __init__(self, resource, request, corpus, query, fmt):
+        self.resource = resource
+        self.request = request
+        self.corpus = corpus
+        self.query = query
+        self.fmt = fmt
+        self.paused = None
+        self.stopped = False
+
+    def pauseProducing(self):
+        if not self.paused:
+            self.paused = Deferred()
+
+    def resumeProducing(self):
+        paused = self.paused
+        self.paused = None
+        if paused:
+            paused.callback(None)
+
+    def stopProducing(self):
+        self.stopped = True
+        self.resumeProducing()
+
+    def write(self, WEs):
+        if self.stopped:
+            return False
+        if self.fmt == "csv":
+            self.request.write(self.resource.format_csv(WEs))
+        else:
+            self.request.write(self.resource.format_ndjson(WEs))
+        return self.paused
+
+    @inlineCallbacks
+    def start(self):
+        self.request.registerProducer(self, True)
+        self.request.notifyFinish().addErrback(lambda _: self.stopProducing())
+        if self.fmt == "csv":
+            self.request.write("%s\r\n" % ",".join(self.resource.csv_fields))
+        try:
+            total = yield self.resource.core.store.export_webentities(self.write, self.query, corpus=self.corpus)
+            logger.msg("Exported %s WebEntities as %s" % (total, self.fmt), system="INFO - %s" % self.corpus)
+        except Exception as e:
+            logger.msg("Error while exporting WebEntities: %s" % e, system="ERROR - %s" % self.corpus)
+            # Cut the connection without ending the chunked response so that
+            # clients see the export failed instead of getting a truncated one
+            self.request.unregisterProducer()
+            if not self.stopped:
+                self.stopped = True
+                self.request.transport.abortConnection()
+            returnD(False)
+        self.request.unregisterProducer()
+        if not self.stopped:
+            self.request.finish()
+        returnD(True)
@@ -3,6 +3,7 @@
 
 from json import loads as loadjson
 from os import environ
+from time import time
 from random import randint
 from urllib import urlencode
 from twisted.python import log as logger
@@ -18,6 +19,8 @@ class JobsQueue(object):
         self.db = MongoDB(config)
         self.scrapyd = 'http://%s:%s/' % (environ.get('HYPHE_CRAWLER_HOST', config['host']), int(environ.get('HYPHE_CRAWLER_PORT', config['scrapy_port'])))
         self.db_name = config["db_name"]
+        self.max_queued_pages = config.get("max_queued_pages", 0)
+        self.backlogs = {}
         self.queue = None
         self.depiler = LoopingCall(self.depile)
         self.depiler.start(0.2, True)
@@ -120,6 +123,8 @@ class JobsQueue(object):
             yield self.init_queue()
         if not len(self.queue):
             returnD(None)
+        if all(self.throttled(job["corpus"]) for job in self.queue.values()):
+            returnD(None)
 
         status = yield self.get_scrapyd_status()
         if not status or status["pending"] > 0:
@@ -128,9 +133,14 @@ class JobsQueue(object):
         # to compete for ScrapyD's empty slots
         yield deferredSleep(1./randint(4,20))
 
-        # Order jobs by corpus with less currently running crawls then age
-        ordered = sorted(self.queue.items(), key=lambda x: \
-          float("%s.%s" % (status.get(x[1]["corpus"], 0), x[1]["timestamp"])))
+        # Skip jobs from corpora with too many pages left to index, and order
+        # others by corpus with less currently running crawls, then faster
+        # indexing backlog to catch up with (by minutes), then age
+        candidates = [(job_id, job) for job_id, job in self.queue.items() if not self.throttled(job["corpus"])]
+        if not candidates:
+            returnD(None)
+        ordered = sorted(candidates, key=lambda x: \
+          (status.get(x[1]["corpus"], 0), int(self.drain_time(x[1]["corpus"]) / 60), x[1]["timestamp"]))
         job_id, job = ordered[0]
         res = yield self.send_scrapy_query('schedule', job["crawl_arguments"])
         ts = now_ts()
@@ -144,6 +154,49 @@ class JobsQueue(object):
             if job_id in self.queue:
                 del(self.queue[job_id])
 
+    # Indexing backlog of each corpus as reported by the core: number of
+    # crawled pages waiting to be indexed and average pages indexed per second
+    def update_backlog(self, corpus, pages_queued):
+        now = time()
+        if corpus not in self.backlogs:
+            self.backlogs[corpus] = {"queued": 0, "indexed": 0, "rate": 0, "updated": now}
+        backlog = self.backlogs[corpus]
+        elapsed = now - backlog["updated"]
+        if elapsed > 0:
+            backlog["rate"] = 0.3 * backlog["indexed"] / elapsed + 0.7 * backlog["rate"]
+        backlog["queued"] = pages_queued
+        backlog["indexed"] = 0
+        backlog["updated"] = now
+
+    def report_indexed(self, corpus, nb_pages):
+        if corpus in self.backlogs:
+            self.backlogs[corpus]["indexed"] += nb_pages
+
+    def forget_backlog(self, corpus):
+        if corpus in self.backlogs:
+            del(self.backlogs[corpus])
+
+    # Hold back new crawls for corpora whose crawls already outrun indexing
+    def throttled(self, corpus):
+        if not self.max_queued_pages or corpus not in self.backlogs:
+            return False
+        return self.backlogs[corpus]["queued"] > self.max_queued_pages
+
+    # Estimated time (in seconds, at most a day) before a corpus' indexing
+    # catches up with its crawls
+    def drain_time(self, corpus):
+        if corpus not in self.backlogs or not self.backlogs[corpus]["queued"]:
+            return 0
+        backlog = self.backlogs[corpus]
+        if not backlog["rate"]:
+            return 86400
+        return min(86400, backlog["queued"] / backlog["rate"])
+
+    def count_throttled_jobs(self, corpus):
+        if not self.throttled(corpus):
+            return 0
+        return self.count_waiting_jobs(corpus)
+
     def cancel_corpus_jobs(self, corpus):
         for _id, job in self.queue.items():
             if job["corpus"] == corpus:
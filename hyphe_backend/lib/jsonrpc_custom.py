@@ -17,6 +17,12 @@ and avoid crashes on logging encoded strings
 
 """
 
+# Marks JSON-RPC methods which only read data, so that they get cancelled
+# along with the work they wait on when their client disconnects
+def cancellable(fct):
+    fct.cancellable = True
+    return fct
+
 class customJSONRPC(JSONRPC):
     def __init__(self, open_cors=False, debug=0):
         self.open_cors = open_cors
@@ -96,9 +102,11 @@ class customJSONRPC(JSONRPC):
             d.addErrback(self._ebRender, id)
             d.addCallback(self._cbRender, request, id, version)
 
-            def _responseFailed(err, call):
-                call.cancel()
-            request.notifyFinish().addErrback(_responseFailed, d)
+            # Methods writing data always run to completion
+            if hasattr(function, 'cancellable'):
+                def _responseFailed(err, call):
+                    call.cancel()
+                request.notifyFinish().addErrback(_responseFailed, d)
         return server.NOT_DONE_YET
 
     def _cbRender(self, result, request, id, version):
@@ -3,6 +3,8 @@
 
 from os import environ
 import msgpack
+from array import array
+from datetime import datetime, timedelta
 from bson.binary import Binary
 from uuid import uuid1 as uuid
 from twisted.internet.defer import inlineCallbacks, returnValue as returnD
@@ -10,10 +12,11 @@ from txmongo import MongoConnection, connection as mongo_connection
 mongo_connection._Pinger.noisy = False
 mongo_connection._Connection.noisy = False
 from txmongo.filter import TEXT as textIndex, sort as mongosort, ASCENDING, DESCENDING
+from pymongo import UpdateOne
 from pymongo.errors import OperationFailure
-from bson import ObjectId
+from bson import ObjectId, BSON
 from hyphe_backend.lib.urllru import name_lru
-from hyphe_backend.lib.utils import crawling_statuses, indexing_statuses, salt, now_ts
+from hyphe_backend.lib.utils import crawling_statuses, indexing_statuses, salt, now_ts, JOB_PRIORITY_USER, LRUCache
 from hyphe_backend.lib.creationrules import getName as name_creationrule
 
 def sortasc(field):
@@ -22,6 +25,9 @@ def sortasc(field):
 def sortdesc(field):
     return mongosort(DESCENDING(field))
 
+# Lifetime in seconds of the WebEntities queries pagination tokens
+WES_QUERIES_TTL = 24 * 3600
+
 class MongoDB(object):
 
     def __init__(self, conf, pool=100):
@@ -29,6 +35,7 @@ class MongoDB(object):
         self.port = int(environ.get('HYPHE_MONGODB_PORT', conf.get("port", conf.get("mongo_port", 27017))))
         self.dbname = conf.get("db_name", conf.get("project", "hyphe"))
         self.conn = MongoConnection(self.host, self.port, pool_size=pool)
+        self.queries_cache = LRUCache(50)
 
     def db(self, corpus=None):
         if not corpus:
@@ -110,6 +117,11 @@ class MongoDB(object):
             yield self.WEs(corpus).create_index(sortasc('name'), background=True)
             yield self.WEs(corpus).create_index(sortasc('status'), background=True)
             yield self.WEs(corpus).create_index(sortasc('crawled'), background=True)
+            yield self.WEs(corpus).create_index(sortasc('sortName'), background=True)
+            yield self.WEs(corpus).create_index(sortasc('indegree'), background=True)
+            yield self.WEs(corpus).create_index(sortasc('status') + sortasc('sortName'), background=True)
+            yield self.WEs(corpus).create_index(sortasc('creationDate'), background=True)
+            yield self.WEs(corpus).create_index(sortasc('lastModificationDate'), background=True)
             yield self.WEs(corpus).create_index(mongosort(textIndex("$**")), background=True)
             yield self.WECRs(corpus).create_index(sortasc('prefix'), background=True)
             yield self.pages(corpus).create_index(sortasc('timestamp'), background=True)
@@ -119,6 +131,7 @@ class MongoDB(object):
             yield self.queue(corpus).create_index(sortasc('timestamp'), background=True)
             yield self.queue(corpus).create_index(sortasc('_job') + sortdesc('timestamp'), background=True)
             yield self.logs(corpus).create_index(sortasc('timestamp'), background=True)
+            yield self.jobs(corpus).create_index(sortasc('crawljob_id'), background=True)
             yield self.jobs(corpus).create_index(sortasc('crawling_status'), background=True)
             yield self.jobs(corpus).create_index(sortasc('indexing_status'), background=True)
             yield self.jobs(corpus).create_index(sortasc('webentity_id'), background=True)
@@ -127,6 +140,7 @@ class MongoDB(object):
             yield self.jobs(corpus).create_index(sortasc('webentity_id') + sortasc("crawling_status") + sortasc("indexing_status") + sortasc('created_at'), background=True)
             yield self.jobs(corpus).create_index(sortasc('crawling_status') + sortasc('indexing_status') + sortasc('created_at'), background=True)
             yield self.stats(corpus).create_index(sortasc('timestamp'), background=True)
+            yield self.queries(corpus).create_index(sortasc('created_at'), expireAfterSeconds=WES_QUERIES_TTL, background=True)
         except OperationFailure as e:
             # catch and destroy old indices built with older pymongo versions
             if retry:
@@ -174,15 +188,37 @@ class MongoDB(object):
         returnD(res)
 
     @inlineCallbacks
-    def get_WEs(self, corpus, query=None):
+    def get_WEs(self, corpus, query=None, **kwargs):
         if not query:
-            res = yield self.WEs(corpus).find()
+            res = yield self.WEs(corpus).find({}, **kwargs)
         else:
             if isinstance(query, list) and isinstance(query[0], int):
                 query = {"_id": {"$in": query}}
-            res = yield self.WEs(corpus).find(query)
+            res = yield self.WEs(corpus).find(query, **kwargs)
         returnD(res)
 
+    @inlineCallbacks
+    def init_WEs_sort_fields(self, corpus, chunk_size=1000):
+        # Fill fields used to sort WebEntities within MongoDB on corpora
+        # created with older versions
+        yield self.WEs(corpus).update({"indegree": {"$exists": False}}, {"$set": {"indegree": 0}}, multi=True)
+        WEs = yield self.WEs(corpus).find({"sortName": {"$exists": False}}, fields=["name"])
+        # Send updates by bulks rather than one round trip per WebEntity
+        for i in range(0, len(WEs), chunk_size):
+            yield self.WEs(corpus).bulk_write([UpdateOne({"_id": WE["_id"]}, {"$set": {"sortName": WE["name"].upper()}}) for WE in WEs[i:i+chunk_size]], ordered=False)
+
+    @inlineCallbacks
+    def update_WEs_indegrees(self, corpus, indegrees):
+        if not indegrees:
+            returnD(None)
+        byvalue = {}
+        for weid, indegree in indegrees.items():
+            if indegree not in byvalue:
+                byvalue[indegree] = []
+            byvalue[indegree].append(weid)
+        for indegree, weids in byvalue.items():
+            yield self.WEs(corpus).update({"_id": {"$in": weids}}, {"$set": {"indegree": indegree}}, multi=True)
+
     @inlineCallbacks
     def get_WE(self, corpus, weid):
         res = yield self.WEs(corpus).find_one({"_id": weid})
@@ -203,30 +239,43 @@ class MongoDB(object):
           "_id": weid,
           "prefixes": prefixes,
           "name": name,
+          "sortName": name.upper(),
           "status": status,
           "tags": tags,
           "homepage": None,
           "startpages": startpages,
           "crawled": False,
+          "indegree": 0,
           "creationDate": timestamp,
           "lastModificationDate": timestamp
         }
 
     @inlineCallbacks
     def add_WE(self, corpus, weid, prefixes, name=None, status="DISCOVERED", startpages=[], tags={}):
-        yield self.upsert_WE(corpus, weid, self.new_WE(weid, prefixes, name, status, startpages, tags), False)
+        WE = self.new_WE(weid, prefixes, name, status, startpages, tags)
+        yield self.upsert_WE(corpus, weid, WE, False)
+        returnD(WE)
 
     @inlineCallbacks
     def add_WEs(self, corpus, new_WEs):
         if not new_WEs:
-            returnD(None)
-        yield self.WEs(corpus).insert_many([self.new_WE(weid, prefixes) for weid, prefixes in new_WEs.items()])
+            returnD([])
+        WEs = [self.new_WE(weid, prefixes) for weid, prefixes in new_WEs.items()]
+        yield self.WEs(corpus).insert_many(WEs)
+        returnD(WEs)
 
     @inlineCallbacks
     def upsert_WE(self, corpus, weid, metas, updateTimestamp=True):
         if updateTimestamp:
             metas["lastModificationDate"] = now_ts()
-        yield self.WEs(corpus).update({"_id": weid}, {"$set": metas}, upsert=True)
+        if "name" in metas:
+            metas["sortName"] = metas["name"].upper()
+        update = {"$set": metas}
+        # Indegrees are maintained by the indexer, only set them on creation
+        if "indegree" in metas:
+            update["$set"] = dict((k, v) for k, v in metas.items() if k != "indegree")
+            update["$setOnInsert"] = {"indegree": metas["indegree"]}
+        yield self.WEs(corpus).update({"_id": weid}, update, upsert=True)
 
     @inlineCallbacks
     def remove_WE(self, corpus, weid):
@@ -306,7 +355,7 @@ class MongoDB(object):
         returnD(jobs)
 
     @inlineCallbacks
-    def add_job(self, corpus, webentity_id, args, timestamp=None):
+    def add_job(self, corpus, webentity_id, args, timestamp=None, priority=JOB_PRIORITY_USER):
         if not timestamp:
             timestamp = now_ts()
         _id = str(uuid())
@@ -318,6 +367,7 @@ class MongoDB(object):
           "nb_unindexed_pages": 0,
           "nb_pages": 0,
           "nb_links": 0,
+          "priority": priority,
           "crawl_arguments": args,
           "crawling_status": crawling_statuses.PENDING,
           "indexing_status": indexing_statuses.PENDING,
@@ -342,8 +392,9 @@ class MongoDB(object):
         elif type(specs) in [str, unicode, bytes]:
             specs = {"_id": specs}
         update = {"$set": modifs}
-        if "inc" in kwargs:
-            update["$inc"] = kwargs.pop("inc")
+        for op in ["inc", "min", "max"]:
+            if op in kwargs:
+                update["$%s" % op] = kwargs.pop(op)
         kwargs["multi"] = True
         yield self.jobs(corpus).update(specs, update, **kwargs)
 
@@ -390,22 +441,71 @@ class MongoDB(object):
             specs = {"_id": ObjectId(specs)}
         yield self.queue(corpus).remove(specs, **kwargs)
 
-    @inlineCallbacks
-    def save_WEs_query(self, corpus, ids, query_options):
-        res = yield self.queries(corpus).insert({
-          "webentities": ids,
+    def _unpack_WEs_query(self, query):
+        query = dict(query)
+        if "specs" in query:
+            query["specs"] = BSON(query["specs"]).decode()
+        if "ids" in query:
+            query["ids"] = array('i', msgpack.unpackb(query["ids"]))
+        if "weights" in query:
+            query["weights"] = array('d', msgpack.unpackb(query["weights"]))
+        return query
+
+    @inlineCallbacks
+    def _save_WEs_query(self, corpus, query):
+        query["created_at"] = datetime.utcnow()
+        res = yield self.queries(corpus).insert(query)
+        token = str(res)
+        self.queries_cache.set((corpus, token), self._unpack_WEs_query(query))
+        returnD(token)
+
+    def save_WEs_query(self, corpus, ids, query_options, weights=None):
+        # Ids and weights are stored as packed arrays, names being resolved
+        # from ids when reading pages
+        query = {
+          "ids": Binary(msgpack.packb(array('i', ids).tostring())),
           "total": len(ids),
           "query": query_options
+        }
+        if weights is not None:
+            query["weights"] = Binary(msgpack.packb(array('d', weights).tostring()))
+        return self._save_WEs_query(corpus, query)
+
+    def save_WEs_query_specs(self, corpus, specs, total, query_options):
+        # MongoDB specs are stored as BSON to keep their operators and regexps
+        return self._save_WEs_query(corpus, {
+          "specs": Binary(BSON.encode(specs or {})),
+          "total": total,
+          "query": query_options
         })
-        returnD(str(res))
+
+    def _expired_WEs_query(self, query):
+        # Tokens from older versions listing WebEntities' ids and names are
+        # considered expired as well as those MongoDB did not remove yet
+        if "ids" not in query and "specs" not in query:
+            return True
+        return datetime.utcnow() - query["created_at"] > timedelta(seconds=WES_QUERIES_TTL)
 
     @inlineCallbacks
     def get_WEs_query(self, corpus, token):
+        res = self.queries_cache.get((corpus, token))
+        if res and self._expired_WEs_query(res):
+            self.queries_cache.pop((corpus, token))
+            returnD(None)
+        if res:
+            returnD(res)
         res = yield self.queries(corpus).find_one({"_id": ObjectId(token)})
+        if not res or self._expired_WEs_query(res):
+            returnD(None)
+        res = self._unpack_WEs_query(res)
+        self.queries_cache.set((corpus, token), res)
         returnD(res)
 
     @inlineCallbacks
     def clean_WEs_query(self, corpus):
+        for key in list(self.queries_cache.data):
+            if key[0] == corpus:
+                self.queries_cache.pop(key)
         yield self.queries(corpus).remove({})
 
     @inlineCallbacks
@@ -2,9 +2,12 @@
 # -*- coding: utf-8 -*-
 
 import os, re, types, time, json, hashlib
+from collections import OrderedDict
 from twisted.web.client import getPage as getPageOrig
 from twisted.internet.task import deferLater
+from twisted.internet.defer import maybeDeferred
 from twisted.internet import reactor
+from twisted.python import log as logger
 from hyphe_backend.lib.config_hci import load_config, DEFAULT_CORPUS
 config = load_config()
 if not config:
@@ -27,6 +30,14 @@ class Enum(set):
 crawling_statuses = Enum(['UNCRAWLED', 'PENDING', 'RUNNING', 'FINISHED', 'CANCELED', 'RETRIED'])
 indexing_statuses = Enum(['UNINDEXED', 'PENDING', 'BATCH_RUNNING', 'BATCH_FINISHED', 'BATCH_CRASHED', 'FINISHED'])
 
+# Version of the crawlers' code, to increment whenever it changes so that
+# corpora started afterwards redeploy their crawler
+CRAWLER_VERSION = 2
+
+# Weights of crawl jobs when sharing indexing between them
+JOB_PRIORITY_USER = 2
+JOB_PRIORITY_AUTO = 1
+
 def now_ts():
     return int(time.time()*1000)
 
@@ -44,6 +55,137 @@ def urls_match_domainlist(urls, domlist):
 def deferredSleep(sleep=5):
     return deferLater(reactor, sleep, lambda : None)
 
+# Alternative to LoopingCall running a function only when woken up:
+# never twice simultaneously, and once more after the current run
+# whenever woken up meanwhile
+class WakeableCall(object):
+
+    def __init__(self, f, *args, **kwargs):
+        self.f = f
+        self.args = args
+        self.kwargs = kwargs
+        self.running = False
+        self.call = None
+        self.deferred = None
+        self.rewake = None
+
+    def start(self):
+        self.running = True
+        self.wake()
+
+    def stop(self):
+        self.running = False
+        self.rewake = None
+        if self.call and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+    def wake(self, delay=0):
+        if not self.running:
+            return
+        if self.deferred:
+            if self.rewake is None or delay < self.rewake:
+                self.rewake = delay
+            return
+        if self.call and self.call.active():
+            if self.call.getTime() <= reactor.seconds() + delay:
+                return
+            self.call.cancel()
+        self.call = reactor.callLater(delay, self._run)
+
+    def _run(self):
+        self.call = None
+        self.deferred = maybeDeferred(self.f, *self.args, **self.kwargs)
+        self.deferred.addErrback(lambda f: logger.msg("Error in %s: %s" % (self.f.__name__, f.getErrorMessage()), system="ERROR"))
+        self.deferred.addCallback(self._done)
+
+    def _done(self, _):
+        self.deferred = None
+        if self.rewake is not None:
+            delay = self.rewake
+            self.rewake = None
+            self.wake(delay)
+
+class LRUCache(object):
+    # Dict-like cache dropping its least recently used keys beyond size
+
+    def __init__(self, size=100):
+        self.size = size
+        self.data = OrderedDict()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def get(self, key, default=None):
+        if key not in self.data:
+            return default
+        value = self.data.pop(key)
+        self.data[key] = value
+        return value
+
+    def set(self, key, value):
+        self.data.pop(key, None)
+        self.data[key] = value
+        while len(self.data) > self.size:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        return self.data.pop(key, default)
+
+    def clear(self):
+        self.data.clear()
+
+# Adds the weights of new links to a {target: {source: weight}} graph of
+# WebEntities links
+def merge_links(graph, links):
+    for target, sources in links.items():
+        if target not in graph:
+            graph[target] = {}
+        for source, weight in sources.items():
+            graph[target][source] = graph[target].get(source, 0) + weight
+
+# Smooth weighted round robin between crawl jobs with pages to index so
+# that a huge crawl cannot hold back the smaller ones, credits being kept
+# between calls
+def pick_weighted_job(credits, jobs):
+    for jobid in credits.keys():
+        if jobid not in jobs:
+            del(credits[jobid])
+    total = 0
+    best = None
+    for jobid, job in jobs.items():
+        weight = job.get('priority', JOB_PRIORITY_USER)
+        total += weight
+        credits[jobid] = credits.get(jobid, 0) + weight
+        if best is None or credits[jobid] > credits[best]:
+            best = jobid
+    credits[best] -= total
+    return jobs[best]
+
+# Sizes the next indexing batches so that indexing one takes about
+# batch_duration seconds, the cost of a batch growing with its links
+def adapt_batch_size(batch, n_pages, n_links, duration, batch_duration, default_size):
+    units = n_pages + n_links
+    if not n_pages or duration <= 0:
+        return None
+    rate = units / duration
+    units_per_page = units / float(n_pages)
+    # Smooth measures over the last batches to avoid oscillations
+    if batch["rate"]:
+        rate = 0.3 * rate + 0.7 * batch["rate"]
+        units_per_page = 0.3 * units_per_page + 0.7 * batch["units_per_page"]
+    batch["rate"] = rate
+    batch["units_per_page"] = units_per_page
+    batch["max_units"] = int(rate * batch_duration)
+    size = batch["max_units"] / units_per_page
+    # Never more than halve or double the size from one batch to the next
+    size = min(2 * batch["size"], max(batch["size"] / 2, size))
+    batch["size"] = int(min(10 * default_size, max(default_size / 10 or 1, size)))
+    return "%s pages with %s links indexed in %.2fs (%d pages+links/s), next batches up to %s pages or %s links" % (n_pages, n_links, duration, rate, batch["size"], batch["max_units"])
+
 re_clean_corpus = re.compile(r'[^a-z0-9_\-]+',)
 def clean_corpus_id(name):
     return re_clean_corpus.sub('-', name.lower().strip("\n\r\t").strip())[:16]
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from array import array
+
+# Statuses coded in alphabetical order so that codes sort as names do
+STATUSES = ["DISCOVERED", "IN", "OUT", "UNDECIDED"]
+STATUS_CODES = dict((s, i) for i, s in enumerate(STATUSES))
+
+class WebEntitiesIndex(object):
+    # Compact in-memory columns of the WebEntities fields used to filter,
+    # sort and paginate lists of WebEntities without querying MongoDB.
+    # Rows of removed WebEntities are refilled with the last row.
+
+    fields = ["name", "status", "indegree", "crawled", "creationDate", "lastModificationDate"]
+    sortable = ["_id"] + fields
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.ids = array('l')
+        self.names = []
+        self.statuses = array('b')
+        self.indegrees = array('l')
+        self.crawled = array('b')
+        self.creation_dates = array('d')
+        self.modification_dates = array('d')
+        self.rows = {}
+        self.loaded = False
+        self.version = 0
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, weid):
+        return weid in self.rows
+
+    def load(self, WEs):
+        self.clear()
+        for WE in WEs:
+            self.update(WE["_id"], WE)
+        self.loaded = True
+
+    def update(self, weid, metas):
+        row = self.rows.get(weid)
+        new = row is None
+        if new:
+            row = self.rows[weid] = len(self.ids)
+            self.ids.append(weid)
+            self.names.append(u"")
+            self.statuses.append(STATUS_CODES["DISCOVERED"])
+            self.indegrees.append(0)
+            self.crawled.append(0)
+            self.creation_dates.append(0)
+            self.modification_dates.append(0)
+        if "name" in metas:
+            self.names[row] = metas["name"]
+        if "status" in metas:
+            self.statuses[row] = STATUS_CODES.get(metas["status"], 0)
+        # Indegrees of known WebEntities only come from set_indegrees: those
+        # read back from MongoDB may predate the latest links computations
+        if new and "indegree" in metas:
+            self.indegrees[row] = metas["indegree"] or 0
+        if "crawled" in metas:
+            self.crawled[row] = int(bool(metas["crawled"]))
+        if "creationDate" in metas:
+            self.creation_dates[row] = metas["creationDate"] or 0
+        if "lastModificationDate" in metas:
+            self.modification_dates[row] = metas["lastModificationDate"] or 0
+        self.version += 1
+
+    def update_many(self, WEs):
+        for WE in WEs:
+            self.update(WE["_id"], WE)
+
+    def set_indegrees(self, indegrees):
+        for weid, indegree in indegrees.items():
+            row = self.rows.get(weid)
+            if row is not None:
+                self.indegrees[row] = indegree
+        if indegrees:
+            self.version += 1
+
+    def remove(self, weid):
+        row = self.rows.pop(weid, None)
+        if row is None:
+            return
+        last = len(self.ids) - 1
+        for column in [self.ids, self.names, self.statuses, self.indegrees, self.crawled, self.creation_dates, self.modification_dates]:
+            if row != last:
+                column[row] = column[last]
+            column.pop()
+        if row != last:
+            self.rows[self.ids[row]] = row
+        self.version += 1
+
+    def get(self, weid, field):
+        row = self.rows.get(weid)
+        if row is None:
+            return None
+        return self.column(field)[row]
+
+    def column(self, field):
+        if field == "_id":
+            return self.ids
+        if field == "name":
+            return self.names
+        if field == "status":
+            return self.statuses
+        if field == "indegree":
+            return self.indegrees
+        if field == "crawled":
+            return self.crawled
+        if field == "creationDate":
+            return self.creation_dates
+        if field == "lastModificationDate":
+            return self.modification_dates
+        raise KeyError(field)
+
+    def select(self, status=None, crawled=None, indegree=None):
+        """Returns the rows of the WebEntities matching a `status`, a
+        `crawled` flag and/or a [min, max] range of `indegree`."""
+        rows = xrange(len(self.ids))
+        if status is not None:
+            code = STATUS_CODES.get(status, -1)
+            statuses = self.statuses
+            rows = [r for r in rows if statuses[r] == code]
+        if crawled is not None:
+            flag = int(bool(crawled))
+            flags = self.crawled
+            rows = [r for r in rows if flags[r] == flag]
+        if indegree is not None:
+            mini, maxi = indegree
+            indegrees = self.indegrees
+            rows = [r for r in rows if mini <= indegrees[r] <= maxi]
+        return list(rows)
+
+    def sort(self, rows, sort):
+        """Sorts `rows` following `sort`, a list of (field, reverse) pairs,
+        names being compared case insensitively."""
+        for field, reverse in reversed(sort):
+            if field == "name":
+                names = self.names
+                key = lambda r: names[r].upper()
+            else:
+                key = self.column(field).__getitem__
+            rows = sorted(rows, key=key, reverse=reverse)
+        return rows
+
+    def to_ids(self, rows):
+        ids = self.ids
+        return array('l', (ids[r] for r in rows))
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import shutil, tempfile
+from time import time
+from twisted.trial import unittest
+from twisted.internet.defer import succeed, inlineCallbacks
+from hyphe_backend.traph.client import LanesQueue, TraphFactory, TraphCorpus, INTERACTIVE, INDEXING, LINKS
+
+class LanesQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = LanesQueue()
+
+    def fill(self, lane, n):
+        for i in range(n):
+            self.queue.put_nowait(lane, "%s-%s" % (lane, i))
+
+    def test_get_lane(self):
+        self.assertEqual(LanesQueue.get_lane("index_batch_crawl"), INDEXING)
+        self.assertEqual(LanesQueue.get_lane("get_webentities_inlinks"), LINKS)
+        self.assertEqual(LanesQueue.get_lane("get_webentity_pages"), INTERACTIVE)
+
+    def test_empty(self):
+        self.assertTrue(self.queue.empty())
+        self.assertEqual(self.queue.next_lane(), None)
+        self.queue.put_iterator_nowait(LINKS, "it")
+        self.assertFalse(self.queue.empty())
+        self.assertFalse(self.queue.empty(LINKS))
+        self.assertTrue(self.queue.empty(INDEXING))
+        self.assertEqual(self.queue.next_lane(), LINKS)
+
+    def test_priorities(self):
+        self.fill(LINKS, 1)
+        self.fill(INDEXING, 1)
+        self.fill(INTERACTIVE, 1)
+        self.assertEqual(self.queue.len(), 3)
+        lanes = []
+        while not self.queue.empty():
+            lane = self.queue.next_lane()
+            lanes.append(lane)
+            self.queue.get_nowait(lane)
+        self.assertEqual(lanes, [INTERACTIVE, INDEXING, LINKS])
+
+    def test_interactive_only(self):
+        self.fill(INDEXING, 1)
+        self.assertEqual(self.queue.next_lane(background=False), None)
+        self.fill(INTERACTIVE, 1)
+        self.assertEqual(self.queue.next_lane(background=False), INTERACTIVE)
+
+    def test_no_starvation(self):
+        self.fill(INTERACTIVE, 30)
+        self.fill(INDEXING, 30)
+        self.fill(LINKS, 30)
+        lanes = []
+        for _ in range(20):
+            lane = self.queue.next_lane()
+            lanes.append(lane)
+            self.queue.get_nowait(lane)
+        self.assertEqual(lanes[:5], [INTERACTIVE] * 4 + [INDEXING])
+        self.assertEqual(lanes.count(INDEXING), 4)
+        self.assertEqual(lanes.count(LINKS), 2)
+        self.assertEqual(lanes.count(INTERACTIVE), 14)
+
+    def test_iterators_alternate_with_new_queries(self):
+        self.fill(INDEXING, 2)
+        self.queue.put_iterator_nowait(INDEXING, "it-0")
+        self.queue.put_iterator_nowait(INDEXING, "it-1")
+        self.queue.put_iterator_nowait(INDEXING, "it-2")
+        got = [self.queue.get_nowait(INDEXING) for _ in range(5)]
+        self.assertEqual(got, ["it-0", "indexing-0", "it-1", "indexing-1", "it-2"])
+        self.assertTrue(self.queue.empty(INDEXING))
+
+class CheckMemoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        # Build the factory without starting any traph process nor monitor
+        self.factory = TraphFactory.__new__(TraphFactory)
+        self.factory.data_dir = self.factory.sockets_dir = self.dir
+        self.factory.max_ram = 250
+        self.factory.pool = []
+        self.factory.corpora = {}
+        self.factory.log = lambda *args, **kwargs: None
+        self.stopped = []
+
+    def corpus(self, name, unused, rss=100):
+        corpus = TraphCorpus(self.factory, name)
+        corpus.status = "ready"
+        corpus.lastcall = time() - unused
+        corpus.memory = lambda: rss
+        def stop():
+            self.stopped.append(name)
+            self.factory.corpora.pop(name)
+            return succeed(True)
+        corpus.stop = stop
+        self.factory.corpora[name] = corpus
+        return corpus
+
+    @inlineCallbacks
+    def test_stops_least_recently_used(self):
+        self.factory.max_ram = 150
+        self.corpus("old", 3600)
+        self.corpus("older", 7200)
+        self.corpus("recent", 600)
+        yield self.factory.check_memory()
+        self.assertEqual(self.stopped, ["older", "old"])
+
+    @inlineCallbacks
+    def test_keeps_busy_corpora(self):
+        self.corpus("recent", 1)
+        self.corpus("running", 3600).call_running = True
+        self.corpus("reading", 3600).replicas_reads = 1
+        self.corpus("starting", 3600).status = "starting"
+        yield self.factory.check_memory()
+        self.assertEqual(self.stopped, [])
+        self.corpus("idle", 3600)
+        yield self.factory.check_memory()
+        self.assertEqual(self.stopped, ["idle"])
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+from twisted.internet.defer import Deferred, succeed, fail, inlineCallbacks
+from hyphe_backend.lib.exports import ExportProducer
+
+class Transport(object):
+
+    def __init__(self):
+        self.aborted = False
+
+    def abortConnection(self):
+        self.aborted = True
+
+class Request(object):
+    # What of a twisted.web request ExportProducer relies on
+
+    def __init__(self):
+        self.transport = Transport()
+        self.written = []
+        self.producer = None
+        self.finished = False
+        self.finishing = Deferred()
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def notifyFinish(self):
+        return self.finishing
+
+    def write(self, data):
+        self.written.append(data)
+
+    def finish(self):
+        self.finished = True
+
+class Resource(object):
+    # Stands for the WebEntitiesExport resource and the core it queries
+
+    csv_fields = ["id", "name"]
+
+    def __init__(self, batches, error=None):
+        self.core = self
+        self.store = self
+        self.batches = batches
+        self.error = error
+
+    def export_webentities(self, write, query, corpus=None):
+        for WEs in self.batches:
+            write(WEs)
+        if self.error:
+            return fail(self.error)
+        return succeed(sum(len(WEs) for WEs in self.batches))
+
+    def format_csv(self, WEs):
+        return "".join("%s,%s\r\n" % (WE["_id"], WE["name"]) for WE in WEs)
+
+    def format_ndjson(self, WEs):
+        return "".join("%s\n" % WE["_id"] for WE in WEs)
+
+BATCHES = [[{"_id": 1, "name": "a"}, {"_id": 2, "name": "b"}], [{"_id": 3, "name": "c"}]]
+
+class ExportProducerTest(unittest.TestCase):
+
+    @inlineCallbacks
+    def test_export(self):
+        request = Request()
+        res = yield ExportProducer(Resource(BATCHES), request, "test", {}, "csv").start()
+        self.assertTrue(res)
+        self.assertEqual("".join(request.written), "id,name\r\n1,a\r\n2,b\r\n3,c\r\n")
+        self.assertTrue(request.finished)
+        self.assertFalse(request.transport.aborted)
+        self.assertEqual(request.producer, None)
+
+    @inlineCallbacks
+    def test_failed_export_aborts_connection(self):
+        request = Request()
+        res = yield ExportProducer(Resource(BATCHES[:1], Exception("boom")), request, "test", {}, "ndjson").start()
+        self.assertFalse(res)
+        self.assertEqual("".join(request.written), "1\n2\n")
+        self.assertFalse(request.finished)
+        self.assertTrue(request.transport.aborted)
+        self.assertEqual(request.producer, None)
+
+    @inlineCallbacks
+    def test_stopped_export(self):
+        request = Request()
+        producer = ExportProducer(Resource(BATCHES), request, "test", {}, "ndjson")
+        producer.stopProducing()
+        yield producer.start()
+        self.assertEqual(request.written, [])
+        self.assertFalse(request.finished)
+        self.assertFalse(request.transport.aborted)
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+from twisted.internet.defer import succeed, inlineCallbacks
+from hyphe_backend.lib import jobsqueue
+from hyphe_backend.lib.jobsqueue import JobsQueue
+
+class FakeTime(object):
+
+    def __init__(self):
+        self.now = 1000.
+
+    def __call__(self):
+        return self.now
+
+class FakeDB(object):
+    # Records the jobs JobsQueue schedules instead of storing them in MongoDB
+
+    def __init__(self):
+        self.scheduled = []
+
+    def update_job(self, corpus, job_id, crawl_id, ts):
+        self.scheduled.append(job_id)
+        return succeed(None)
+
+    def add_log(self, corpus, job_id, msg, ts):
+        return succeed(None)
+
+class JobsQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.time = FakeTime()
+        self.patch(jobsqueue, "time", self.time)
+        self.patch(jobsqueue, "deferredSleep", lambda s: succeed(None))
+        # Build the queue without its MongoDB connection nor depiling loop
+        self.jobs = JobsQueue.__new__(JobsQueue)
+        self.jobs.db = FakeDB()
+        self.jobs.max_queued_pages = 1000
+        self.jobs.backlogs = {}
+        self.jobs.queue = {}
+        self.scrapyd_status = {"pending": 0}
+        self.jobs.get_scrapyd_status = lambda: succeed(self.scrapyd_status)
+        self.sent = []
+        self.jobs.send_scrapy_query = self.send_scrapy_query
+
+    def send_scrapy_query(self, action, arguments=None):
+        self.sent.append(arguments)
+        return succeed({"jobid": "crawl-%s" % len(self.sent)})
+
+    def queue(self, job_id, corpus, timestamp):
+        self.jobs.queue[job_id] = {
+          "corpus": corpus,
+          "timestamp": timestamp,
+          "crawl_arguments": {"job": job_id}
+        }
+
+    def index(self, corpus, queued, indexed, elapsed):
+        self.jobs.report_indexed(corpus, indexed)
+        self.time.now += elapsed
+        self.jobs.update_backlog(corpus, queued)
+
+    def test_backlog_rate(self):
+        self.jobs.update_backlog("test", 500)
+        self.assertEqual(self.jobs.backlogs["test"]["rate"], 0)
+        self.index("test", 400, 100, 10)
+        self.assertEqual(self.jobs.backlogs["test"]["rate"], 3)
+        self.assertEqual(self.jobs.backlogs["test"]["queued"], 400)
+        self.assertEqual(self.jobs.backlogs["test"]["indexed"], 0)
+        self.index("test", 400, 0, 10)
+        self.assertAlmostEqual(self.jobs.backlogs["test"]["rate"], 2.1)
+        self.jobs.report_indexed("unknown", 100)
+        self.assertNotIn("unknown", self.jobs.backlogs)
+
+    def test_drain_time(self):
+        self.assertEqual(self.jobs.drain_time("test"), 0)
+        self.jobs.update_backlog("test", 500)
+        self.assertEqual(self.jobs.drain_time("test"), 86400)
+        self.index("test", 300, 100, 10)
+        self.assertEqual(self.jobs.drain_time("test"), 100)
+        self.index("test", 0, 0, 10)
+        self.assertEqual(self.jobs.drain_time("test"), 0)
+
+    def test_throttled(self):
+        self.assertFalse(self.jobs.throttled("test"))
+        self.jobs.update_backlog("test", 1000)
+        self.assertFalse(self.jobs.throttled("test"))
+        self.jobs.update_backlog("test", 1001)
+        self.assertTrue(self.jobs.throttled("test"))
+        self.jobs.max_queued_pages = 0
+        self.assertFalse(self.jobs.throttled("test"))
+        self.jobs.max_queued_pages = 1000
+        self.jobs.forget_backlog("test")
+        self.assertFalse(self.jobs.throttled("test"))
+
+    def test_count_throttled_jobs(self):
+        self.queue("a", "test", 1)
+        self.queue("b", "test", 2)
+        self.queue("c", "other", 3)
+        self.assertEqual(self.jobs.count_throttled_jobs("test"), 0)
+        self.jobs.update_backlog("test", 5000)
+        self.assertEqual(self.jobs.count_throttled_jobs("test"), 2)
+        self.assertEqual(self.jobs.count_throttled_jobs("other"), 0)
+
+    @inlineCallbacks
+    def test_depile_skips_throttled_corpora(self):
+        self.queue("a", "test", 1)
+        self.queue("b", "other", 2)
+        self.jobs.update_backlog("test", 5000)
+        yield self.jobs.depile()
+        self.assertEqual(self.jobs.db.scheduled, ["b"])
+        self.assertEqual(self.sent, [{"job": "b"}])
+        self.assertEqual(list(self.jobs.queue), ["a"])
+        self.scrapyd_status = None
+        yield self.jobs.depile()
+        self.assertEqual(self.jobs.db.scheduled, ["b"])
+
+    @inlineCallbacks
+    def test_depile_nothing_when_all_throttled(self):
+        self.queue("a", "test", 1)
+        self.jobs.update_backlog("test", 5000)
+        self.jobs.get_scrapyd_status = lambda: self.fail("ScrapyD should not be queried")
+        yield self.jobs.depile()
+        self.assertEqual(self.sent, [])
+        self.assertIn("a", self.jobs.queue)
+
+    @inlineCallbacks
+    def test_depile_order(self):
+        self.queue("a", "busy", 1)
+        self.queue("b", "slow", 2)
+        self.queue("c", "fast", 3)
+        self.queue("d", "fast", 4)
+        self.scrapyd_status = {"pending": 0, "busy": 2}
+        self.jobs.update_backlog("slow", 900)
+        self.jobs.update_backlog("fast", 100)
+        self.index("slow", 900, 10, 1)
+        self.index("fast", 100, 10, 1)
+        for _ in range(4):
+            yield self.jobs.depile()
+        self.assertEqual(self.jobs.db.scheduled, ["c", "d", "b", "a"])
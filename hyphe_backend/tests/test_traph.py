@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os, shutil, tempfile
+from twisted.trial import unittest
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, CancelledError, inlineCallbacks, returnValue
+from twisted.internet.protocol import Factory
+from twisted.internet.endpoints import UNIXServerEndpoint, UNIXClientEndpoint
+from hyphe_backend.traph.server import TraphServerFactory
+from hyphe_backend.traph.client import TraphClientProtocol, TraphCorpus
+from hyphe_backend.lib.utils import merge_links
+
+class Corpus(object):
+    # What of a TraphCorpus a client connected to a traph server relies on
+
+    def __init__(self, query_timeout=0, iteration_slice=50):
+        self.factory = self
+        self.query_timeout = query_timeout
+        self.iteration_slice = iteration_slice
+        self.status = "starting"
+        self.lastcall = 0
+        self.call_running = False
+        self.connected = Deferred()
+
+    def ready(self):
+        self.status = "ready"
+        self.connected.callback(None)
+
+    def log(self, msg, error=False):
+        pass
+
+class TraphClientServerTest(unittest.TestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.server = TraphServerFactory("test", traph_dir=self.dir)
+        self.client = yield self.connect(self.server, "test.sock")
+        self.corpus = self.client.corpus
+
+    @inlineCallbacks
+    def connect(self, server, name):
+        self.addCleanup(server.close)
+        sock = os.path.join(self.dir, name)
+        port = yield UNIXServerEndpoint(reactor, sock).listen(server)
+        self.addCleanup(port.stopListening)
+        client = TraphClientProtocol(Corpus())
+        factory = Factory()
+        factory.buildProtocol = lambda addr: client
+        yield UNIXClientEndpoint(reactor, sock).connect(factory)
+        self.addCleanup(client.transport.loseConnection)
+        yield client.corpus.connected
+        returnValue(client)
+
+    def call(self, method, *args, **kwargs):
+        return self.client.sendMessage(method, *args, **kwargs)
+
+    @inlineCallbacks
+    def test_index_batch_crawl(self):
+        lrus = [
+          "s:http|h:com|h:site1|",
+          "s:http|h:com|h:site1|p:page|",
+          "s:http|h:com|h:site2|",
+          "s:http|h:com|h:site3|p:page|"
+        ]
+        res = yield self.call("index_batch_crawl", {0: [1, 2, 3], 2: [3]}, lrus)
+        self.assertEqual(res["code"], "success")
+        WEs = yield self.call("multi", [["get_webentity_by_prefix", [prefix]] for prefix in lrus[::2] + ["s:http|h:com|h:site3|"]])
+        site1, site2, site3 = [WE["result"] for WE in WEs["result"]]
+        self.assertEqual(res["result"]["webentities_links"], {
+          site2: {site1: 1},
+          site3: {site1: 1, site2: 1}
+        })
+
+    @inlineCallbacks
+    def test_index_batch_crawl_links_merge(self):
+        # Links reported batch by batch add up to those rebuilt entirely
+        batches = [
+          {
+            "s:http|h:com|h:site1|": ["s:http|h:com|h:site2|p:a|", "s:http|h:com|h:site3|", "s:http|h:com|h:site1|p:b|"],
+            "s:http|h:com|h:site2|": ["s:http|h:com|h:site1|"]
+          }, {
+            "s:http|h:com|h:site2|p:a|": ["s:http|h:com|h:site1|p:b|", "s:http|h:com|h:site3|p:c|"],
+            "s:http|h:com|h:site3|": ["s:http|h:com|h:site1|", "s:http|h:com|h:site2|"]
+          }
+        ]
+        links = {}
+        for batch in batches:
+            res = yield self.call("index_batch_crawl", batch)
+            self.assertEqual(res["code"], "success")
+            merge_links(links, res["result"]["webentities_links"])
+        WElinks = yield self.call("get_webentities_inlinks", include_auto=False)
+        # Recent traph versions also count the pages of each webentity there
+        WElinks = dict((target, dict((source, weight) for source, weight in sources.items() if isinstance(source, int))) for target, sources in WElinks["result"].items())
+        self.assertEqual(links, WElinks)
+
+    @inlineCallbacks
+    def test_index_batch_crawl_iterates(self):
+        batch = dict(("s:http|h:com|h:site%s|" % i, ["s:http|h:com|h:site%s|p:%s|" % (i + 1, j) for j in range(10)]) for i in range(100))
+        res = yield self.call("index_batch_crawl", batch)
+        self.assertEqual(res["code"], "success")
+        self.assertTrue(res["query"]["total_time"] >= 0)
+        self.assertEqual(len(res["result"]["webentities_links"]), 100)
+
+    @inlineCallbacks
+    def test_cancelled_write_runs_to_completion(self):
+        self.corpus.query_timeout = 0.000001
+        d = self.call("create_webentity", ["s:http|h:com|h:site1|"])
+        d.cancel()
+        yield self.assertFailure(d, CancelledError)
+        self.corpus.query_timeout = 0
+        res = yield self.call("get_webentity_by_prefix", "s:http|h:com|h:site1|")
+        self.assertEqual(res["code"], "success")
+
+    @inlineCallbacks
+    def test_replica_sees_writes(self):
+        replica = yield self.connect(TraphServerFactory("test", traph_dir=self.dir, readonly=True), "replica.sock")
+        res = yield replica.sendMessage("create_webentity", ["s:http|h:com|h:site1|"])
+        self.assertEqual(res["code"], "fail")
+        for i in range(3):
+            res = yield self.call("create_webentity", ["s:http|h:com|h:site%s|" % i])
+            self.assertEqual(res["code"], "success")
+            res = yield replica.sendMessage("reopen")
+            self.assertEqual(res["code"], "success")
+            res = yield replica.sendMessage("get_webentity_by_prefix", "s:http|h:com|h:site%s|" % i)
+            self.assertEqual(res["code"], "success")
+        # Replicas serve all reads, not only get_ and count_ methods
+        res = yield replica.sendMessage("retrieve_webentity", "s:http|h:com|h:site1|p:page|")
+        self.assertEqual(res["code"], "success")
+
+    @inlineCallbacks
+    def test_replica_gets_new_creation_rules(self):
+        replica = yield self.connect(TraphServerFactory("test", traph_dir=self.dir, readonly=True), "replica.sock")
+        factory = type("TraphFactory", (object,), {"sockets_dir": self.dir, "data_dir": self.dir})()
+        primary = TraphCorpus(factory, "test", WECRs=TraphServerFactory.WECRs)
+        primary.client = self.client
+        primary.replicas = [TraphCorpus(factory, "test_replica1", primary=primary)]
+        primary.replicas[0].status = "ready"
+        primary.replicas[0].client = replica
+        prefix = "s:http|h:com|h:site|"
+        res = yield primary.call("add_webentity_creation_rule", prefix, "(s:[a-zA-Z]+\\|(h:[^\\|]+\\|)+(p:[^\\|]+\\|){1})")
+        self.assertEqual(res["code"], "success")
+        self.assertIn(prefix, primary.options["WECRs"])
+        yield primary.refresh_replicas()
+        self.assertTrue(primary.replicas[0].fresh)
+        res = yield replica.sendMessage("get_potential_prefix", prefix + "p:page|p:sub|")
+        self.assertEqual(res["code"], "success")
+        self.assertEqual(res["result"], prefix + "p:page|")
+        res = yield primary.call("remove_webentity_creation_rule", prefix)
+        self.assertEqual(res["code"], "success")
+        yield primary.refresh_replicas()
+        res = yield replica.sendMessage("get_potential_prefix", prefix + "p:page|p:sub|")
+        self.assertEqual(res["code"], "success")
+        self.assertEqual(res["result"], prefix)
+
+    @inlineCallbacks
+    def test_get_webentities_most_linked_pages(self):
+        res = yield self.call("index_batch_crawl", {"s:http|h:com|h:site1|": ["s:http|h:com|h:site2|p:a|", "s:http|h:com|h:site2|"]})
+        self.assertEqual(res["code"], "success")
+        WE = yield self.call("get_webentity_by_prefix", "s:http|h:com|h:site2|")
+        WE = WE["result"]
+        res = yield self.call("get_webentities_most_linked_pages", [[WE, ["s:http|h:com|h:site2|"]], [WE + 1, ["s:http|h:com|h:unknown|"]]], pages_count=5)
+        self.assertEqual(res["code"], "success")
+        self.assertEqual(len(res["result"][WE]), 2)
+        self.assertEqual(res["result"][WE + 1]["code"], "fail")
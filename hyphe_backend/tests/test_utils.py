@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+from twisted.internet.defer import Deferred
+from hyphe_backend.lib import utils
+from hyphe_backend.lib.utils import LRUCache, WakeableCall, pick_weighted_job, adapt_batch_size, JOB_PRIORITY_USER, JOB_PRIORITY_AUTO
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_drops_least_recently_used(self):
+        cache = LRUCache(size=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("c", 3)
+        self.assertEqual(len(cache), 2)
+        self.assertNotIn("b", cache)
+        self.assertEqual(cache.get("b", "missing"), "missing")
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_set_refreshes(self):
+        cache = LRUCache(size=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.set("a", 4)
+        cache.set("c", 3)
+        self.assertEqual(cache.get("a"), 4)
+        self.assertNotIn("b", cache)
+
+    def test_pop_and_clear(self):
+        cache = LRUCache(size=2)
+        cache.set("a", 1)
+        self.assertEqual(cache.pop("a"), 1)
+        self.assertEqual(cache.pop("a"), None)
+        cache.set("b", 2)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+class WakeableCallTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(utils, "reactor", self.clock)
+        self.runs = []
+        self.call = WakeableCall(self.loop)
+
+    def loop(self):
+        d = Deferred()
+        self.runs.append(d)
+        return d
+
+    def test_runs_only_when_woken(self):
+        self.call.wake()
+        self.clock.advance(0)
+        self.assertEqual(self.runs, [])
+        self.call.start()
+        self.clock.advance(0)
+        self.assertEqual(len(self.runs), 1)
+        self.runs[0].callback(None)
+        self.clock.advance(10)
+        self.assertEqual(len(self.runs), 1)
+        self.call.wake(5)
+        self.clock.advance(4)
+        self.assertEqual(len(self.runs), 1)
+        self.clock.advance(1)
+        self.assertEqual(len(self.runs), 2)
+
+    def test_earliest_wake_wins(self):
+        self.call.start()
+        self.clock.advance(0)
+        self.runs[0].callback(None)
+        self.call.wake(10)
+        self.call.wake(20)
+        self.call.wake(2)
+        self.clock.advance(2)
+        self.assertEqual(len(self.runs), 2)
+        self.runs[1].callback(None)
+        self.clock.advance(20)
+        self.assertEqual(len(self.runs), 2)
+
+    def test_rewakes_after_current_run(self):
+        self.call.start()
+        self.clock.advance(0)
+        self.call.wake()
+        self.call.wake()
+        self.clock.advance(0)
+        self.assertEqual(len(self.runs), 1)
+        self.runs[0].callback(None)
+        self.clock.advance(0)
+        self.assertEqual(len(self.runs), 2)
+        self.runs[1].callback(None)
+        self.clock.advance(0)
+        self.assertEqual(len(self.runs), 2)
+
+    def test_rewakes_after_failure(self):
+        self.call.start()
+        self.clock.advance(0)
+        self.call.wake(1)
+        self.runs[0].errback(Exception("boom"))
+        self.clock.advance(1)
+        self.assertEqual(len(self.runs), 2)
+        self.flushLoggedErrors()
+
+    def test_stop(self):
+        self.call.start()
+        self.clock.advance(0)
+        self.call.wake()
+        self.call.stop()
+        self.runs[0].callback(None)
+        self.clock.advance(0)
+        self.call.wake()
+        self.clock.advance(0)
+        self.assertEqual(len(self.runs), 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+class PickWeightedJobTest(unittest.TestCase):
+
+    def test_shares_by_priority(self):
+        jobs = {
+          "user": {"_id": "user", "priority": JOB_PRIORITY_USER},
+          "auto": {"_id": "auto", "priority": JOB_PRIORITY_AUTO}
+        }
+        credits = {}
+        picked = [pick_weighted_job(credits, jobs)["_id"] for _ in range(30)]
+        self.assertEqual(picked[:3], ["user", "auto", "user"])
+        self.assertEqual(picked.count("user"), 20)
+        self.assertEqual(picked.count("auto"), 10)
+
+    def test_forgets_finished_jobs(self):
+        credits = {"gone": 5}
+        jobs = {"new": {"_id": "new"}}
+        self.assertEqual(pick_weighted_job(credits, jobs)["_id"], "new")
+        self.assertEqual(credits, {"new": 0})
+
+class AdaptBatchSizeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.batch = {"size": 100, "max_units": 0, "rate": 0, "units_per_page": 0}
+
+    def adapt(self, n_pages, n_links, duration):
+        return adapt_batch_size(self.batch, n_pages, n_links, duration, 4, 100)
+
+    def test_sizes_on_duration(self):
+        self.assertTrue(self.adapt(100, 900, 2))
+        self.assertEqual(self.batch["rate"], 500)
+        self.assertEqual(self.batch["max_units"], 2000)
+        self.assertEqual(self.batch["size"], 200)
+
+    def test_ignores_empty_measures(self):
+        self.assertEqual(self.adapt(0, 0, 2), None)
+        self.assertEqual(self.adapt(100, 900, 0), None)
+        self.assertEqual(self.batch["size"], 100)
+        self.assertEqual(self.batch["rate"], 0)
+
+    def test_smoothes_and_bounds_changes(self):
+        self.adapt(100, 900, 2)
+        self.adapt(100, 900, 0.1)
+        self.assertEqual(self.batch["rate"], 3350)
+        self.assertEqual(self.batch["size"], 400)
+        for _ in range(10):
+            self.adapt(1000, 0, 0.01)
+        self.assertEqual(self.batch["size"], 1000)
+        for _ in range(10):
+            self.adapt(10, 100000, 100)
+        self.assertEqual(self.batch["size"], 10)
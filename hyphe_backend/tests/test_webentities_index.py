@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+from hyphe_backend.lib.webentities_index import WebEntitiesIndex
+
+WEBENTITIES = [
+  {"_id": 1, "name": u"beta", "status": "IN", "indegree": 3, "crawled": True, "creationDate": 10, "lastModificationDate": 40},
+  {"_id": 2, "name": u"Alpha", "status": "OUT", "indegree": 7, "crawled": False, "creationDate": 20, "lastModificationDate": 30},
+  {"_id": 3, "name": u"gamma", "status": "IN", "indegree": 0, "crawled": False, "creationDate": 30, "lastModificationDate": 20},
+  {"_id": 4, "name": u"delta", "status": "DISCOVERED", "indegree": 3, "crawled": True, "creationDate": 40, "lastModificationDate": 10}
+]
+
+class WebEntitiesIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = WebEntitiesIndex()
+        self.index.load(WEBENTITIES)
+
+    def assertConsistent(self):
+        index = self.index
+        self.assertEqual(len(index.rows), len(index))
+        for column in ["_id"] + index.fields:
+            self.assertEqual(len(index.column(column)), len(index))
+        for weid, row in index.rows.items():
+            self.assertEqual(index.ids[row], weid)
+
+    def test_load(self):
+        self.assertTrue(self.index.loaded)
+        self.assertEqual(len(self.index), 4)
+        self.assertIn(2, self.index)
+        self.assertNotIn(5, self.index)
+        self.assertEqual(self.index.get(2, "name"), u"Alpha")
+        self.assertEqual(self.index.get(2, "indegree"), 7)
+        self.assertEqual(self.index.get(5, "name"), None)
+        self.assertConsistent()
+
+    def test_update(self):
+        version = self.index.version
+        self.index.update(3, {"status": "OUT", "lastModificationDate": 50})
+        self.assertEqual(self.index.get(3, "status"), self.index.get(2, "status"))
+        self.assertEqual(self.index.get(3, "lastModificationDate"), 50)
+        self.assertEqual(self.index.get(3, "name"), u"gamma")
+        self.index.update(5, {"name": u"epsilon"})
+        self.assertEqual(len(self.index), 5)
+        self.assertEqual(self.index.get(5, "indegree"), 0)
+        self.assertEqual(list(self.index.to_ids(self.index.select(status="DISCOVERED"))), [4, 5])
+        self.assertTrue(self.index.version > version)
+        self.assertConsistent()
+
+    def test_set_indegrees(self):
+        self.index.set_indegrees({1: 12, 5: 4})
+        self.assertEqual(self.index.get(1, "indegree"), 12)
+        self.assertNotIn(5, self.index)
+        # Edited WebEntities read from MongoDB do not bring back stale indegrees
+        self.index.update(1, dict(WEBENTITIES[0], name=u"renamed"))
+        self.assertEqual(self.index.get(1, "name"), u"renamed")
+        self.assertEqual(self.index.get(1, "indegree"), 12)
+        self.assertEqual(list(self.index.to_ids(self.index.select(indegree=[10, 20]))), [1])
+
+    def test_select(self):
+        rows = self.index.select(status="IN")
+        self.assertEqual(list(self.index.to_ids(rows)), [1, 3])
+        rows = self.index.select(crawled=True)
+        self.assertEqual(list(self.index.to_ids(rows)), [1, 4])
+        rows = self.index.select(indegree=[1, 5])
+        self.assertEqual(list(self.index.to_ids(rows)), [1, 4])
+        rows = self.index.select(status="IN", crawled=False)
+        self.assertEqual(list(self.index.to_ids(rows)), [3])
+        self.assertEqual(self.index.select(status="UNKNOWN"), [])
+        self.assertEqual(len(self.index.select()), 4)
+
+    def test_sort(self):
+        rows = self.index.select()
+        sort = lambda s: list(self.index.to_ids(self.index.sort(rows, s)))
+        self.assertEqual(sort([("name", False)]), [2, 1, 4, 3])
+        self.assertEqual(sort([("lastModificationDate", False)]), [4, 3, 2, 1])
+        self.assertEqual(sort([("indegree", True), ("name", False)]), [2, 1, 4, 3])
+        self.assertEqual(sort([("status", False), ("_id", True)]), [4, 3, 1, 2])
+
+    def test_remove(self):
+        self.index.remove(2)
+        self.assertNotIn(2, self.index)
+        self.assertEqual(len(self.index), 3)
+        # The last row was moved in place of the removed one
+        self.assertEqual(self.index.rows[4], 1)
+        self.assertEqual(self.index.get(4, "name"), u"delta")
+        self.assertEqual(self.index.get(4, "creationDate"), 40)
+        self.assertEqual(self.index.get(4, "crawled"), 1)
+        self.assertConsistent()
+        self.assertEqual(list(self.index.to_ids(self.index.select(crawled=True))), [1, 4])
+
+    def test_remove_last(self):
+        self.index.remove(4)
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(self.index.rows, {1: 0, 2: 1, 3: 2})
+        self.assertConsistent()
+        self.index.remove(4)
+        self.assertEqual(len(self.index), 3)
+
+    def test_remove_all(self):
+        for weid in [3, 1, 4, 2]:
+            self.index.remove(weid)
+            self.assertConsistent()
+        self.assertEqual(len(self.index), 0)
+        self.index.update(1, {"name": u"beta"})
+        self.assertEqual(self.index.rows, {1: 0})
@@ -1,38 +1,53 @@
 import os, sys
+from collections import deque
 import json, msgpack
 from time import time, sleep
 from twisted.python import log
 from twisted.internet import reactor
 from twisted.internet.task import LoopingCall
-from twisted.internet.defer import Deferred, inlineCallbacks, returnValue as returnD
+from twisted.internet.defer import Deferred, DeferredList, maybeDeferred, inlineCallbacks, returnValue as returnD
 from twisted.internet.error import ConnectError
-from twisted.internet.protocol import ProcessProtocol, Factory
+from twisted.internet.protocol import ProcessProtocol, Factory, Protocol
 from twisted.internet.endpoints import UNIXClientEndpoint
-from twisted.protocols.basic import LineOnlyReceiver
-from hyphe_backend.lib.utils import deferredSleep, lightLogVar
+from hyphe_backend.lib.utils import deferredSleep, lightLogVar, is_error
 from hyphe_backend.lib import config_hci
+from hyphe_backend.traph.methods import is_read_method
 config = config_hci.load_config()
 
 class TraphFactory(object):
 
     # TODO:
-    # handle timedout queries
     # handle max started corpus ?
-    # max ram ?
 
     sockets_dir = "traph-sockets"
+    # Minimum time (in seconds) a corpus must have been unused to be stopped
+    # when over the RAM budget, so that busy ones are not restarted over and over
+    min_idle = 120
 
     # TODO reset default chatty to False when fixed problem starting traph with it
-    def __init__(self, data_dir="traph-data", max_corpus=0, chatty=True):
+    def __init__(self, data_dir="traph-data", max_corpus=0, max_ram=0, query_timeout=0, pool_size=0, replicas=0, iteration_slice=50, chatty=True):
         self.data_dir = data_dir
         self.max_corpus = max_corpus
+        self.max_ram = max_ram
+        self.iteration_slice = iteration_slice
+        self.replicas = replicas
+        self.query_timeout = query_timeout
+        self.pool_size = pool_size
         self.chatty = chatty
         self.corpora = {}
+        self.pool = []
+        self.workers = 0
         if not os.path.isdir(self.data_dir):
             os.makedirs(self.data_dir)
         if not os.path.isdir(self.sockets_dir):
             os.makedirs(self.sockets_dir)
+        self.clean_pool()
         reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+        if self.pool_size:
+            reactor.callWhenRunning(self.fill_pool)
+        self.ram_monitor = LoopingCall(self.check_memory)
+        if self.max_ram:
+            reactor.callWhenRunning(self.ram_monitor.start, 30, False)
 
     def log(self, name, msg, error=False, quiet=False):
         if quiet and not error:
@@ -87,9 +102,36 @@ class TraphFactory(object):
         if self.is_full():
             self.log(name, "Too many Traphs already opened", True)
             return False
+        worker = self.pop_worker()
+        if worker:
+            self.corpora[name] = worker
+            worker.bind(name, quiet=quiet, **kwargs)
+            self.fill_pool()
+            return True
         self.corpora[name] = TraphCorpus(self, name, quiet=quiet, **kwargs)
         return self.corpora[name].start()
 
+    # Pool of warm traph processes waiting to be bound to a corpus
+    def fill_pool(self):
+        self.pool = [w for w in self.pool if not w.stopping()]
+        while len(self.pool) < self.pool_size:
+            self.workers += 1
+            worker = TraphCorpus(self, "_pool_%s" % self.workers, quiet=not config["DEBUG"], pooled=True)
+            self.pool.append(worker)
+            worker.start()
+
+    def pop_worker(self):
+        for worker in self.pool:
+            if worker.status == "pooled":
+                self.pool.remove(worker)
+                return worker
+        return None
+
+    def clean_pool(self):
+        for f in os.listdir(self.sockets_dir):
+            if f.startswith("_pool_") and f.endswith(".pid"):
+                TraphCorpus(self, f[:-4], quiet=True, pooled=True).checkAndRemovePID(True)
+
     @inlineCallbacks
     def stop_corpus(self, name, quiet=False):
         if self.stopped_corpus(name):
@@ -102,6 +144,9 @@ class TraphFactory(object):
 
     @inlineCallbacks
     def stop(self):
+        self.pool_size = 0
+        for worker in self.pool:
+            yield worker.stop(now=True)
         for corpus in self.corpora:
             yield self.stop_corpus(corpus, True)
 
@@ -110,15 +155,48 @@ class TraphFactory(object):
             return {"code": "fail", "message": "Corpus traph not ready"}
         return self.corpora[corpus].call(method, *args, **kwargs)
 
+    # Resident memory (in MB) of all traph processes, including pooled ones
+    def memory(self):
+        return sum([c.memory() for c in self.corpora.values() + self.pool])
+
+    def memory_corpus(self, name):
+        if name not in self.corpora:
+            return 0
+        return self.corpora[name].memory()
+
+    # When over the RAM budget, stop idle corpora, least recently used first
+    @inlineCallbacks
+    def check_memory(self):
+        total = self.memory()
+        if total <= self.max_ram:
+            returnD(None)
+        idle = sorted([c for c in self.corpora.values() if c.idle(self.min_idle)], key=lambda c: c.lastcall)
+        for corpus in idle:
+            if total <= self.max_ram:
+                break
+            rss = corpus.memory()
+            self.log(corpus.name, "Stopping idle Traph (%sMB, unused for %ss) to stay within the %sMB RAM budget (%sMB used)" % (rss, int(time() - corpus.lastcall), self.max_ram, total))
+            yield corpus.stop()
+            total -= rss
+        if total > self.max_ram:
+            self.log("traph", "WARNING: Traphs use %sMB of RAM, above the %sMB budget, but no more idle corpus can be stopped" % (total, self.max_ram))
+
+    def queries_status(self, corpus):
+        if not self.test_corpus(corpus):
+            return {}
+        return self.corpora[corpus].queries_status()
+
 class TraphCorpus(object):
 
     exec_path = os.path.join("hyphe_backend", "traph", "server.py")
     #daemon = True
 
-    def __init__(self, factory, name, default_WECR=None, WECRs=None, keepalive=1800, quiet=False, **kwargs):
+    def __init__(self, factory, name, default_WECR=None, WECRs=None, keepalive=1800, quiet=False, pooled=False, primary=None, **kwargs):
         self.factory = factory
         self.status = "init"
         self.name = name
+        self.pooled = pooled
+        self.primary = primary
         self.socket = os.path.join(self.factory.sockets_dir, name)
         self.pidfile = self.socket + ".pid"
         self.options = {
@@ -126,10 +204,18 @@ class TraphCorpus(object):
           "default_WECR": default_WECR,
           "WECRs": WECRs
         }
+        if self.primary:
+            self.options["readonly"] = True
         self.quiet = quiet
         self.keepalive = keepalive
         self.lastcall = time()
         self.call_running = False
+        self.replicas = []
+        self.replicas_reads = 0
+        self.writes_running = 0
+        self.writes_generation = 0
+        self.generation = 0
+        self.fresh = False
         self.monitor = LoopingCall(self.__check_timeout__)
         self.error = None
         self.transport = None
@@ -143,13 +229,21 @@ class TraphCorpus(object):
           sys.executable,
           "-u",
           self.exec_path,
-          self.socket,
-          self.name
+          self.socket
         ]
         self.checkAndRemovePID(True)
-        with open(self.socket+"-options.json", "w") as f:
-            json.dump(self.options, f)
-        self.log("Starting Traph for at least %ss: %s" % (self.keepalive, " ".join(cmd)))
+        if self.pooled:
+            self.log("Starting pooled Traph worker: %s" % " ".join(cmd))
+        elif self.primary:
+            cmd.append(self.primary.name)
+            with open(self.socket+"-options.json", "w") as f:
+                json.dump(self.options, f)
+            self.log("Starting read-only Traph replica: %s" % " ".join(cmd))
+        else:
+            cmd.append(self.name)
+            with open(self.socket+"-options.json", "w") as f:
+                json.dump(self.options, f)
+            self.log("Starting Traph for at least %ss: %s" % (self.keepalive, " ".join(cmd)))
         self.protocol = TraphProcessProtocol(self.socket, self)
         self.transport = reactor.spawnProcess(
           self.protocol,
@@ -162,14 +256,160 @@ class TraphCorpus(object):
         self.client = self.protocol.client
         return True
 
+    def ready(self):
+        if self.pooled:
+            self.log("Traph worker ready")
+            self.status = "pooled"
+            return
+        if self.primary:
+            self.log("Traph replica ready")
+            self.status = "ready"
+            # Replicas started during writes get reopened once these are done
+            if self.primary.writes_running:
+                return
+            if self.generation == self.primary.writes_generation:
+                self.fresh = True
+            else:
+                self.primary.refresh_replicas()
+            return
+        self.log("Traph ready")
+        self.status = "ready"
+        self.monitor.start(max(1, int(self.keepalive/6)))
+        self.start_replicas()
+
+    def start_replicas(self):
+        for i in range(self.factory.replicas):
+            replica = TraphCorpus(self.factory, "%s_replica%s" % (self.name, i+1), self.options["default_WECR"], self.options["WECRs"], quiet=self.quiet, primary=self)
+            replica.generation = self.writes_generation
+            self.replicas.append(replica)
+            replica.start()
+
+    # Opens a corpus within an already running pooled worker
+    @inlineCallbacks
+    def bind(self, name, default_WECR=None, WECRs=None, keepalive=1800, quiet=False, **kwargs):
+        self.log("Binding pooled Traph worker to corpus %s" % name)
+        self.name = name
+        self.options["default_WECR"] = default_WECR
+        self.options["WECRs"] = WECRs
+        self.keepalive = keepalive
+        self.quiet = quiet
+        self.pooled = False
+        self.status = "starting"
+        self.lastcall = time()
+        res = yield self.client.sendMessage("bind", name, _timeout=0, **self.options)
+        if is_error(res):
+            self.log("Could not bind Traph worker: %s" % res["message"], True)
+            if self.transport:
+                self.protocol.stop()
+                self.transport = None
+            returnD(False)
+        self.ready()
+        returnD(True)
+
+    # With replicas, reads are sent to an up-to-date one unless writes are
+    # running, and writes wait for reads running on replicas to finish
+    # before modifying the traph files under them
     def call(self, method, *args, **kwargs):
+        if not self.replicas:
+            return self.client.sendMessage(method, *args, **kwargs)
+        self.lastcall = time()
+        if not is_read_method(method, args):
+            return self.write(method, *args, **kwargs)
+        if not self.writes_running:
+            replicas = [r for r in self.replicas if r.status == "ready" and r.fresh]
+            if replicas:
+                replica = min(replicas, key=lambda r: len(r.client.pending) + r.client.queue.len())
+                return self.read_replica(replica, method, *args, **kwargs)
         return self.client.sendMessage(method, *args, **kwargs)
 
+    @inlineCallbacks
+    def read_replica(self, replica, method, *args, **kwargs):
+        self.replicas_reads += 1
+        try:
+            res = yield replica.call(method, *args, **kwargs)
+        finally:
+            self.replicas_reads -= 1
+        returnD(res)
+
+    @inlineCallbacks
+    def write(self, method, *args, **kwargs):
+        self.writes_running += 1
+        self.writes_generation += 1
+        for replica in self.replicas:
+            replica.fresh = False
+        try:
+            while self.replicas_reads:
+                yield deferredSleep(0.05)
+            res = yield self.client.sendMessage(method, *args, **kwargs)
+        finally:
+            self.writes_running -= 1
+        if not is_error(res):
+            self.track_creation_rules(method, args)
+        if not self.writes_running:
+            self.refresh_replicas()
+        returnD(res)
+
+    # Replicas rebuild their traph with the creation rules they are given,
+    # so keep these up to date with the ones added to or removed from the
+    # primary since it started
+    def track_creation_rules(self, method, args):
+        if method == "multi":
+            for call in args[0]:
+                self.track_creation_rules(call[0], call[1] if len(call) > 1 else [])
+            return
+        if method not in ["add_webentity_creation_rule", "add_webentity_creation_rule_iter", "remove_webentity_creation_rule"]:
+            return
+        WECRs = dict(self.options["WECRs"] or {})
+        if method == "remove_webentity_creation_rule":
+            WECRs.pop(args[0], None)
+        else:
+            WECRs[args[0]] = args[1]
+        self.options["WECRs"] = WECRs
+
+    def refresh_replicas(self):
+        generation = self.writes_generation
+        reopens = []
+        for replica in self.replicas:
+            if replica.status != "ready":
+                continue
+            replica.options["WECRs"] = self.options["WECRs"]
+            replica.generation = generation
+            def refreshed(res, replica):
+                if is_error(res):
+                    replica.log("Could not reopen Traph replica: %s" % res["message"])
+                elif replica.generation == self.writes_generation and not self.writes_running:
+                    replica.fresh = True
+            reopens.append(replica.client.sendMessage("reopen", WECRs=self.options["WECRs"], _timeout=0).addCallback(refreshed, replica))
+        return DeferredList(reopens)
+
+    def memory(self):
+        return self.process_memory() + sum([r.process_memory() for r in self.replicas])
+
+    def process_memory(self):
+        if not self.transport or not self.transport.pid:
+            return 0
+        try:
+            with open("/proc/%s/status" % self.transport.pid) as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) / 1024
+        except (IOError, ValueError):
+            pass
+        return 0
+
+    def queries_status(self):
+        res = self.client.queue.depth()
+        res["running"] = len(self.client.pending)
+        return res
+
+    # Whether the corpus has been left unused for more than delay seconds
+    def idle(self, delay):
+        return self.status == "ready" and time() - self.lastcall > delay and not self.call_running and not self.replicas_reads
+
     @inlineCallbacks
     def __check_timeout__(self):
-        delay = time() - self.lastcall
-        if self.status == "ready" and self.keepalive < delay and not self.call_running:
-            self.log("Stopping after %ss of inactivity" % int(delay))
+        if self.idle(self.keepalive):
+            self.log("Stopping after %ss of inactivity" % int(time() - self.lastcall))
             yield self.stop()
 
     def stopping(self):
@@ -180,10 +420,12 @@ class TraphCorpus(object):
         if self.monitor.running:
             self.monitor.stop()
         if self.stopping():
+            yield self.stop_replicas()
             returnD(None)
         self.status = "error" if self.error else "stopping"
-        while not now and self.call_running:
+        while not now and (self.call_running or self.replicas_reads):
             yield deferredSleep(0.1)
+        yield self.stop_replicas()
         if self.transport:
             self.protocol.stop()
             self.transport = None
@@ -193,6 +435,13 @@ class TraphCorpus(object):
         else:
             self.checkAndRemovePID()
 
+    @inlineCallbacks
+    def stop_replicas(self):
+        replicas = self.replicas
+        self.replicas = []
+        for replica in replicas:
+            yield replica.stop(now=True)
+
     def checkAndRemovePID(self, warn=False):
         if os.path.exists(self.pidfile):
             if warn:
@@ -275,7 +524,7 @@ class TraphProcessProtocol(ProcessProtocol):
 class Queue(object):
 
     def __init__(self):
-        self.queue = []
+        self.queue = deque()
 
     def empty(self):
         return len(self.queue) == 0
@@ -284,94 +533,311 @@ class Queue(object):
         self.queue.append(value)
 
     def get_nowait(self):
-        return self.queue.pop(0)
+        return self.queue.popleft()
 
     def len(self):
         return len(self.queue)
 
     def drop(self):
-        self.queue = []
+        self.queue.clear()
+
+INTERACTIVE = "interactive"
+INDEXING = "indexing"
+LINKS = "links"
+
+# Background methods, any other one is considered interactive
+LANES_METHODS = {
+  "index_batch_crawl": INDEXING,
+  "get_webentities_inlinks": LINKS
+}
+
+class LanesQueue(object):
+    """Dispatches queries between lanes of decreasing priority: a lane is
+    only served when all higher ones are empty, unless it already got
+    skipped max_skips times in a row while holding queries. Within a lane,
+    continuations of iterative queries alternate with new queries."""
+
+    lanes = [INTERACTIVE, INDEXING, LINKS]
+    max_skips = {
+      INTERACTIVE: 0,
+      INDEXING: 4,
+      LINKS: 8
+    }
+
+    def __init__(self):
+        self.queues = {}
+        self.iterators = {}
+        self.skipped = {}
+        self.iterated = {}
+        for lane in self.lanes:
+            self.queues[lane] = Queue()
+            self.iterators[lane] = Queue()
+            self.skipped[lane] = 0
+            self.iterated[lane] = False
+
+    @classmethod
+    def get_lane(cls, method):
+        return LANES_METHODS.get(method, INTERACTIVE)
+
+    def empty(self, lane=None):
+        if lane:
+            return self.queues[lane].empty() and self.iterators[lane].empty()
+        return all(self.empty(l) for l in self.lanes)
+
+    def put_nowait(self, lane, value):
+        self.queues[lane].put_nowait(value)
+
+    def put_iterator_nowait(self, lane, value):
+        self.iterators[lane].put_nowait(value)
+
+    def next_lane(self, background=True):
+        candidates = [l for l in self.lanes if not self.empty(l) and (background or l == INTERACTIVE)]
+        if not candidates:
+            return None
+        starving = [l for l in candidates if self.max_skips[l] and self.skipped[l] >= self.max_skips[l]]
+        lane = starving[0] if starving else candidates[0]
+        for l in candidates:
+            self.skipped[l] = 0 if l == lane else self.skipped[l] + 1
+        return lane
+
+    def get_nowait(self, lane):
+        if not self.iterators[lane].empty() and (
+          self.queues[lane].empty() or not self.iterated[lane]
+        ):
+            self.iterated[lane] = True
+            return self.iterators[lane].get_nowait()
+        self.iterated[lane] = False
+        return self.queues[lane].get_nowait()
+
+    def len(self):
+        return sum(self.queues[l].len() for l in self.lanes)
+
+    def len_iterators(self):
+        return sum(self.iterators[l].len() for l in self.lanes)
 
-class TraphClientProtocol(LineOnlyReceiver):
+    def depth(self):
+        return dict((l, self.queues[l].len() + self.iterators[l].len()) for l in self.lanes)
+
+    def drop(self):
+        for lane in self.lanes:
+            self.queues[lane].drop()
+            self.iterators[lane].drop()
+
+    def remove(self, queryId):
+        for lane in self.lanes:
+            for queue in [self.queues[lane], self.iterators[lane]]:
+                for item in queue.queue:
+                    if item[4] == queryId:
+                        queue.queue.remove(item)
+                        return item
+        return None
+
+# msgpack messages are self-delimited: both ends write packed objects
+# back to back on the socket and decode them on the fly with a streaming
+# Unpacker, so large answers never get buffered whole then rescanned
+class TraphClientProtocol(Protocol):
 
-    delimiter = b"\r\n##TxHypheMsgPackDelimiter\r\n"
     MAX_LENGTH = 536870912
+    # Number of queries sent to the traph server without waiting for their answers
+    MAX_PIPELINED = 4
+    # Default number of elements per chunk sent back for streamed queries
+    STREAM_CHUNK_SIZE = 10000
 
     def __init__(self, corpus):
         self.corpus = corpus
-        self.deferred = None
-        self.queue = Queue()
-        self.iteratorQueue = Queue()
+        self.queue = LanesQueue()
+        self.pending = {}
         self.last_query = None
-        self.start_query = None
+        self.last_id = 0
+        self.deadlines = {}
+        self.streaming = {}
+        self.abandoned = set()
+        self.unpacker = msgpack.Unpacker(max_buffer_size=self.MAX_LENGTH)
 
     def connectionMade(self):
-        self.corpus.log("Traph ready")
-        self.corpus.status = "ready"
-        self.corpus.monitor.start(max(1, int(self.corpus.keepalive/6)))
-
+        self.corpus.ready()
+
+    # A callable given as _stream makes the server send back the result in
+    # chunks of _chunk_size elements (or [key, value] pairs for dict results)
+    # which are passed to it as they arrive; the returned deferred then
+    # only fires with the total number of elements streamed.
+    # Interactive read queries get a default deadline, other reads only when
+    # given a _timeout (0 for none), after which they are answered with an
+    # error and abandoned server side. Cancelling the returned deferred
+    # abandons them too. Writes always run to completion so that the traph
+    # never gets only partly modified nor diverges from MongoDB.
     def sendMessage(self, method, *args, **kwargs):
-        deferred = Deferred()
+        self.last_id += 1
+        queryId = self.last_id
+        read = is_read_method(method, args)
+        deferred = Deferred(lambda d: self.abandonQuery(queryId) if read else None)
+        lane = kwargs.pop("_lane", None) or LanesQueue.get_lane(method)
+        stream = kwargs.pop("_stream", None)
+        chunk_size = kwargs.pop("_chunk_size", None) or self.STREAM_CHUNK_SIZE
+        if stream:
+            stream = (stream, chunk_size)
+        timeout = kwargs.pop("_timeout", None)
+        if timeout is None and lane == INTERACTIVE:
+            timeout = self.corpus.factory.query_timeout
+        if timeout and read:
+            self.deadlines[queryId] = (time() + timeout, reactor.callLater(timeout, self.expireQuery, queryId, method, timeout))
         self.corpus.lastcall = time()
-        self.queue.put_nowait((deferred, method, args, kwargs))
-        if self.corpus.status == "ready" and not self.deferred:
+        self.queue.put_nowait(lane, (deferred, method, args, kwargs, queryId, stream))
+        if self.corpus.status == "ready" or method == "bind":
             self._sendMessageNow()
         return deferred
 
-    def reiterateMessage(self, deferred, iteratorId, *args, **kwargs):
-        self.iteratorQueue.put_nowait((deferred, "iterate_previous_query", [iteratorId], kwargs))
+    def reiterateMessage(self, deferred, iteratorId, queryId, lane, stream=None):
+        self.queue.put_iterator_nowait(lane, (deferred, "iterate_previous_query", [iteratorId], {}, queryId, stream))
         self._sendMessageNow()
 
+    def streamChunk(self, query, msg):
+        consumer = query["stream"][0]
+        self.streaming[msg["id"]] = query
+        def next_chunk(_):
+            # Query abandoned while the consumer was processing the chunk
+            if not self.streaming.pop(msg["id"], None):
+                return self.sendMessage("cancel_iterator", msg["iterator"])
+            self.reiterateMessage(query["deferred"], msg["iterator"], msg["id"], query["lane"], query["stream"])
+        def consumer_failed(failure):
+            if not self.streaming.pop(msg["id"], None):
+                return self.sendMessage("cancel_iterator", msg["iterator"])
+            self.corpus.log("Streaming consumer failed on %s: %s" % (query["query"]["method"], failure.getErrorMessage()), True)
+            self.sendMessage("cancel_iterator", msg["iterator"])
+            self.clearDeadline(msg["id"])
+            query["deferred"].callback({
+              "code": "fail",
+              "message": "Streaming consumer failed: %s" % failure.getErrorMessage(),
+              "query": query["query"]["method"]
+            })
+        maybeDeferred(consumer, msg["chunk"]).addCallbacks(next_chunk, consumer_failed)
+
+    def clearDeadline(self, queryId):
+        deadline = self.deadlines.pop(queryId, None)
+        if deadline and deadline[1].active():
+            deadline[1].cancel()
+
+    def abandonQuery(self, queryId):
+        self.clearDeadline(queryId)
+        # Not sent yet: simply forget it, closing its server iterator if any
+        item = self.queue.remove(queryId)
+        if item:
+            deferred, method, args = item[:3]
+            if method == "iterate_previous_query":
+                self.sendMessage("cancel_iterator", args[0])
+            return deferred
+        # Already running: ignore its answer when it comes back
+        if queryId in self.pending:
+            query = self.pending.pop(queryId)
+            self.abandoned.add(queryId)
+            self.corpus.call_running = len(self.pending) > 0
+            self._sendMessageNow()
+            return query["deferred"]
+        # Streamed query waiting for its consumer
+        if queryId in self.streaming:
+            return self.streaming.pop(queryId)["deferred"]
+        return None
+
+    def expireQuery(self, queryId, method, timeout):
+        self.deadlines.pop(queryId, None)
+        deferred = self.abandonQuery(queryId)
+        if deferred and not deferred.called:
+            self.corpus.log("WARNING: traph query #%s %s timed out after %ss" % (queryId, method, timeout))
+            deferred.callback({
+              "code": "fail",
+              "message": "Traph query %s timed out after %ss" % (method, timeout),
+              "query": method
+            })
+
     def _sendMessageNow(self):
-        if self.queue.empty() and self.iteratorQueue.empty():
-            return
+        while len(self.pending) < self.MAX_PIPELINED:
+            # Always keep one slot free for interactive queries
+            lane = self.queue.next_lane(background=len(self.pending) < self.MAX_PIPELINED - 1)
+            if not lane:
+                return
+            self._sendNextMessage(lane)
+
+    def _sendNextMessage(self, lane):
         self.corpus.call_running = True
-        if not self.iteratorQueue.empty() and (
-          self.queue.empty() or
-          (self.last_query and self.last_query["method"] != "iterate_previous_query")
-        ):
-            queue = self.iteratorQueue
-        else: queue = self.queue
-        self.deferred, method, args, kwargs = queue.get_nowait()
+        deferred, method, args, kwargs, queryId, stream = self.queue.get_nowait(lane)
         if config["DEBUG"] and (method != "iterate_previous_query" or config["DEBUG"] == 2):
-            self.corpus.log("Traph client query: %s %s %s" % (method, lightLogVar(args), lightLogVar(kwargs)))
+            self.corpus.log("Traph client query #%s (%s): %s %s %s" % (queryId, lane, method, lightLogVar(args), lightLogVar(kwargs)))
         self.last_query = {
+          "id": queryId,
           "method": method,
           "args": args,
           "kwargs": kwargs
         }
+        # Iterative queries run by slices of time on the server, or step by
+        # step when they would otherwise delay waiting interactive queries
+        if lane != INTERACTIVE and not self.queue.empty(INTERACTIVE):
+            self.last_query["slice"] = 0
+        else:
+            self.last_query["slice"] = self.corpus.factory.iteration_slice / 1000.
+        if method != "iterate_previous_query":
+            if stream:
+                self.last_query["stream"] = stream[1]
+            if queryId in self.deadlines:
+                self.last_query["deadline"] = self.deadlines[queryId][0]
         if method == "clear":
-            self.corpus.log("Dropping cleared traph queued queries: %s calls & %s iterative calls" % (self.queue.len(), self.iteratorQueue.len()))
-            self.iteratorQueue.drop()
+            self.corpus.log("Dropping cleared traph queued queries: %s calls & %s iterative calls" % (self.queue.len(), self.queue.len_iterators()))
             self.queue.drop()
-        self.start_query = time()
-        self.sendLine(msgpack.packb(self.last_query))
-
-    def lineLengthExceeded(self, line):
-        self.corpus.log("Line length (%s) exceeded limit (%s) on UNIX socket: %s %s" % (len(line), self.MAX_LENGTH, type(e), e), True)
+        self.pending[queryId] = {
+          "deferred": deferred,
+          "lane": lane,
+          "stream": stream,
+          "query": self.last_query,
+          "start": time()
+        }
+        self.transport.write(msgpack.packb(self.last_query))
 
-    def lineReceived(self, data):
+    def dataReceived(self, data):
         self.corpus.lastcall = time()
         try:
-            msg = msgpack.unpackb(data)
-            if config["DEBUG"]:
-                exec_time = time() - self.start_query
-                if exec_time > 1:
-                    self.corpus.log("WARNING: query took a long time! (%ss) %s %s %s" % (exec_time, self.last_query["method"], lightLogVar(self.last_query["args"]), lightLogVar(self.last_query["kwargs"])))
-            if config["DEBUG"] == 2:
-                self.corpus.log("Traph server answer: %s" % lightLogVar(msg))
-            if "iterator" in msg:
-                return self.reiterateMessage(self.deferred, msg["iterator"])
-            self.deferred.callback(msg)
-        except (msgpack.exceptions.ExtraData, msgpack.exceptions.UnpackValueError) as e:
-            error = "%s: %s - Received badly formatted data of length %s in answer to %s %s %s" % (type(e), e, len(data), self.last_query["method"], lightLogVar(self.last_query["args"]), lightLogVar(self.last_query["kwargs"]))
+            self.unpacker.feed(data)
+            answers = list(self.unpacker)
+        except (msgpack.exceptions.BufferFull, ValueError) as e:
+            # The stream cannot be resynchronized nor answers matched to their queries anymore, so fail all those awaiting one
+            error = "%s: %s - Received badly formatted or oversized data (max %s) while %s queries were running" % (type(e), e, self.MAX_LENGTH, len(self.pending))
             self.corpus.log(error, True)
-            if self.deferred:
-                self.deferred.errback(Exception(error))
-        self.corpus.call_running = False
-        self.deferred = None
+            self.unpacker = msgpack.Unpacker(max_buffer_size=self.MAX_LENGTH)
+            pending = self.pending.items()
+            self.pending = {}
+            for queryId, query in pending:
+                self.clearDeadline(queryId)
+                query["deferred"].errback(Exception(error))
+        else:
+            for msg in answers:
+                self._answerReceived(msg)
+        self.corpus.call_running = len(self.pending) > 0
         self._sendMessageNow()
 
+    def _answerReceived(self, msg):
+        queryId = msg.get("id")
+        if queryId in self.abandoned:
+            self.abandoned.discard(queryId)
+            if "iterator" in msg:
+                self.sendMessage("cancel_iterator", msg["iterator"])
+            return
+        if queryId not in self.pending:
+            self.corpus.log("Received traph answer for unknown query id %s: %s" % (queryId, lightLogVar(msg)), True)
+            return
+        query = self.pending.pop(queryId)
+        if config["DEBUG"]:
+            exec_time = time() - query["start"]
+            if exec_time > 1:
+                self.corpus.log("WARNING: query took a long time! (%ss) %s %s %s" % (exec_time, query["query"]["method"], lightLogVar(query["query"]["args"]), lightLogVar(query["query"]["kwargs"])))
+        if config["DEBUG"] == 2:
+            self.corpus.log("Traph server answer #%s: %s" % (queryId, lightLogVar(msg)))
+        if "chunk" in msg:
+            return self.streamChunk(query, msg)
+        if "iterator" in msg:
+            return self.reiterateMessage(query["deferred"], msg["iterator"], queryId, query["lane"], query["stream"])
+        self.clearDeadline(queryId)
+        # Cancelled writes still run but nobody waits for them anymore
+        if not query["deferred"].called:
+            query["deferred"].callback(msg)
+
 
 if __name__ == "__main__":
     corpus = "test"
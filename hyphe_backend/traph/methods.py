@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Shared by the traph client and server, hence importing nothing from hyphe
+
+# Methods modifying the traph: any other one only reads it, can be served by
+# read-only replicas and be abandoned when its caller gives up on it
+WRITE_METHODS = set([
+  "add_page",
+  "add_pages",
+  "add_links",
+  "index_batch_crawl",
+  "index_batch_crawl_iter",
+  "create_webentity",
+  "delete_webentity",
+  "add_prefix_to_webentity",
+  "remove_prefix_from_webentity",
+  "move_prefix_to_webentity",
+  "move_prefix_to_webentity_from_webentity",
+  "add_webentity_creation_rule",
+  "add_webentity_creation_rule_iter",
+  "remove_webentity_creation_rule",
+  "clear",
+  "close"
+])
+
+def is_read_method(method, args=None):
+    if method == "multi":
+        return bool(args) and all(is_read_method(call[0]) for call in args[0])
+    return method not in WRITE_METHODS
@@ -1,30 +1,56 @@
 import os, sys, json, msgpack
 from time import time
+from itertools import islice
 from types import GeneratorType
 from traph import Traph, TraphException, TraphWriteReport, TraphIteratorState
 from twisted.internet import reactor
-from twisted.internet.protocol import Factory
+from twisted.internet.protocol import Factory, Protocol
 from twisted.internet.endpoints import UNIXServerEndpoint
-from twisted.protocols.basic import LineOnlyReceiver
+# Launched as a script, the server only sees the modules next to it
+from methods import is_read_method
+
 
 class TraphIterator(object):
 
-    def __init__(self, iteratorId, iterator, query):
+    def __init__(self, iteratorId, iterator, query, queryId=None, stream=None, deadline=None, time_slice=0):
         self.id = iteratorId
         self.iter = iterator
         self.query = query
+        self.queryId = queryId
+        self.stream = stream
+        self.deadline = deadline
+        self.time_slice = time_slice
+        self.chunks = None
+        self.streamed = 0
         self.n_iterations = 0
         self.iteration_time = 0
+        self.steps_times = []
         self.total_time = 0
 
-class TraphProtocol(LineOnlyReceiver):
+def chunk_result(res, size):
+    if isinstance(res, TraphWriteReport):
+        res = res.__dict__()
+    if isinstance(res, dict):
+        res = res.iteritems()
+    elif isinstance(res, (list, tuple, set)):
+        res = iter(res)
+    else:
+        res = iter([res])
+    chunk = list(islice(res, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(res, size))
+
+# Queries and answers are msgpack objects written back to back on the socket
+# and decoded on the fly with a streaming Unpacker
+class TraphProtocol(Protocol):
 
-    delimiter = b"\r\n##TxHypheMsgPackDelimiter\r\n"
     MAX_LENGTH = 536870912
 
-    def __init__(self, traph):
-        self.traph = traph
+    def __init__(self, factory):
+        self.factory = factory
         self.iterators = {}
+        self.unpacker = msgpack.Unpacker(max_buffer_size=self.MAX_LENGTH)
 
     def connectionMade(self):
         pass
@@ -32,86 +58,271 @@ class TraphProtocol(LineOnlyReceiver):
     def connectionLost(self, reason):
         pass
 
-    def returnResult(self, res, query):
+    # Each answer carries the id of the query it responds to so that the client
+    # can match it whatever the order in which queries complete
+    def returnResult(self, res, query, queryId=None):
         if isinstance(res, TraphWriteReport):
             res = res.__dict__()
-        self.sendLine(msgpack.packb({
+        self.transport.write(msgpack.packb({
+          "id": queryId,
           "code": "success",
           "result": res,
           "query": query
         }))
 
     def returnIterator(self, iterator, iteratorState):
-        self.sendLine(msgpack.packb({
+        self.transport.write(msgpack.packb({
+          "id": iterator.queryId,
           "code": "success",
           "iterator": iterator.id,
           "iterations": iterator.n_iterations,
           "atomic_iterations": iteratorState.n_iterations,
           "iteration_time": iterator.iteration_time,
+          "steps_times": iterator.steps_times,
           "query": iterator.query
         }))
 
-    def returnError(self, msg, query):
-        self.sendLine(msgpack.packb({
+    def returnError(self, msg, query, queryId=None):
+        self.transport.write(msgpack.packb({
+          "id": queryId,
           "code": "fail",
           "message": msg,
           "query": query
         }))
 
-    def iterate(self, iteratorId):
+    def returnChunk(self, iterator):
+        try:
+            chunk = next(iterator.chunks)
+        except StopIteration:
+            del(self.iterators[iterator.id])
+            return self.returnResult(iterator.streamed, {"method": iterator.query, "total_time": iterator.total_time, "stream": True}, iterator.queryId)
+        iterator.streamed += len(chunk)
+        self.transport.write(msgpack.packb({
+          "id": iterator.queryId,
+          "code": "success",
+          "iterator": iterator.id,
+          "chunk": chunk,
+          "query": iterator.query
+        }))
+
+    # Advances the iterator repeatedly until its time slice is used, or only
+    # once when the client asks for a null slice to serve other queries
+    def iterate(self, iteratorId, queryId=None, time_slice=None):
         iterator = self.iterators[iteratorId]
+        if queryId is not None:
+            iterator.queryId = queryId
+        if time_slice is not None:
+            iterator.time_slice = time_slice
+        # Stop working on queries the client already gave up on
+        if iterator.deadline and time() > iterator.deadline:
+            del(self.iterators[iteratorId])
+            return self.returnError("Query timed out after %s iterations (%ss)" % (iterator.n_iterations, iterator.total_time), iterator.query, iterator.queryId)
+        if iterator.chunks:
+            return self.returnChunk(iterator)
+        slice_start = time()
+        iterator.steps_times = []
         try:
-            start_time = time()
-            state = next(iterator.iter)
-            iterator.iteration_time = time() - start_time
+            while True:
+                start_time = time()
+                state = next(iterator.iter)
+                iterator.steps_times.append(time() - start_time)
+                iterator.n_iterations += 1
+                if state.done or time() - slice_start >= iterator.time_slice or \
+                  (iterator.deadline and time() > iterator.deadline):
+                    break
+            iterator.iteration_time = time() - slice_start
             iterator.total_time += iterator.iteration_time
-            iterator.n_iterations += 1
         except StopIteration:
             del(self.iterators[iteratorId])
-            return self.returnError("Tried to iterate on already closed iterative query!", iterator.query)
+            return self.returnError("Tried to iterate on already closed iterative query!", iterator.query, iterator.queryId)
         if not state.done:
             return self.returnIterator(iterator, state)
+        if iterator.stream:
+            iterator.chunks = chunk_result(state.result, iterator.stream)
+            return self.returnChunk(iterator)
         del(self.iterators[iteratorId])
-        return self.returnResult(state.result, {"method": iterator.query, "total_time": iterator.total_time})
+        self.flushWrites(iterator.query)
+        return self.returnResult(state.result, {"method": iterator.query, "total_time": iterator.total_time}, iterator.queryId)
+
+    # Writes reach the traph files before being acknowledged, so that
+    # replicas reopening them right after see them whole
+    def flushWrites(self, method, args=None):
+        if not is_read_method(method, args):
+            self.factory.flush()
+
+    # Runs a list of [method, args, kwargs] calls within a single query and
+    # returns the list of their individual results
+    def multi(self, calls, deadline=None):
+        results = []
+        for call in calls:
+            method = call[0]
+            args = call[1] if len(call) > 1 else []
+            kwargs = call[2] if len(call) > 2 else {}
+            if deadline and time() > deadline:
+                results.append({"code": "fail", "message": "Query timed out before being processed"})
+                continue
+            try:
+                fct = getattr(Traph, method)
+            except AttributeError as e:
+                results.append({"code": "fail", "message": "Called non existing Traph method: %s" % str(e)})
+                continue
+            try:
+                res = fct(self.factory.traph, *args, **kwargs)
+                if isinstance(res, TraphWriteReport):
+                    res = res.__dict__()
+                results.append({"code": "success", "result": res})
+            except TraphException as e:
+                results.append({"code": "fail", "message": "Traph raised: %s" % str(e)})
+            except Exception as e:
+                results.append({"code": "fail", "message": str(e)})
+        return results
 
-    def lineReceived(self, query):
+    # Indexes a batch of crawled pages and also reports the weights of the
+    # links between webentities it added, so that the core can update its
+    # graph without having to rebuild it entirely
+    def index_batch_crawl(self, data, lrus=None):
+        traph = self.factory.traph
+        # Pages and links can be given as indexes within a table of LRUs
+        if lrus is not None:
+            data = dict((lrus[source], [lrus[target] for target in targets]) for source, targets in data.items())
+        for state in traph.index_batch_crawl_iter(data, 50):
+            if state.done:
+                break
+            yield state
+        report = state.result.__dict__()
+        state = TraphIteratorState()
+        webentities = {}
+        def webentity(lru):
+            if lru not in webentities:
+                try:
+                    webentities[lru] = traph.retrieve_webentity(lru)
+                # Pages outside of any webentity are just left out of links
+                except TraphException:
+                    webentities[lru] = None
+            return webentities[lru]
+        links = {}
+        for source_lru, targets in data.items():
+            source = webentity(source_lru)
+            if not source:
+                continue
+            for target_lru in targets:
+                target = webentity(target_lru)
+                # Skip self links as get_webentities_inlinks(include_auto=False)
+                if not target or target == source:
+                    continue
+                if target not in links:
+                    links[target] = {}
+                links[target][source] = links[target].get(source, 0) + 1
+            if state.should_yield(50):
+                yield state
+        report["webentities_links"] = links
+        yield state.finalize(report)
+
+    # Returns the most linked pages of many webentities given as a list of
+    # [id, prefixes] at once, sparing a query per webentity, or an error for
+    # those which could not be processed
+    def get_webentities_most_linked_pages(self, webentities, pages_count=10):
+        traph = self.factory.traph
+        res = {}
+        for weid, prefixes in webentities:
+            try:
+                res[weid] = traph.get_webentity_most_linked_pages(weid, prefixes, pages_count=pages_count)
+            except TraphException as e:
+                res[weid] = {"code": "fail", "message": "Traph raised: %s" % str(e)}
+            except Exception as e:
+                res[weid] = {"code": "fail", "message": str(e)}
+        return res
+
+    def dataReceived(self, data):
         try:
-            query = msgpack.unpackb(query)
-        except (msgpack.exceptions.ExtraData, msgpack.exceptions.UnpackValueError) as e:
-            return self.returnError("Query is not a valid JSON object: %s" % str(e), query)
+            self.unpacker.feed(data)
+            queries = list(self.unpacker)
+        except (msgpack.exceptions.BufferFull, ValueError) as e:
+            print >> sys.stderr, "WARNING received badly formatted or oversized data server side (max %s): %s" % (self.MAX_LENGTH, e)
+            self.unpacker = msgpack.Unpacker(max_buffer_size=self.MAX_LENGTH)
+            return self.returnError("Query is not a valid msgpack object: %s" % str(e), None)
+        for query in queries:
+            self.queryReceived(query)
+
+    def queryReceived(self, query):
+        queryId = query.get("id") if isinstance(query, dict) else None
         try:
             method = query["method"]
-            iter_method = "%s_iter" % method
-            if hasattr(Traph, iter_method):
-                method = iter_method
             args = query["args"]
             kwargs = query["kwargs"]
         except KeyError as e:
-            return self.returnError("Argument missing from JSON query: %s" % str(e), query)
+            return self.returnError("Argument missing from JSON query: %s" % str(e), query, queryId)
         if method == "iterate_previous_query":
             if not args:
-                return self.returnError("No iterator id given.", query)
+                return self.returnError("No iterator id given.", query, queryId)
             if args[0] not in self.iterators:
-                return self.returnError("No iterator pending with id %s." % args[0], query)
-            return self.iterate(args[0])
-        try:
-            fct = getattr(Traph, method)
-        except AttributeError as e:
-            return self.returnError("Called non existing Traph method: %s" % str(e), query)
+                return self.returnError("No iterator pending with id %s." % args[0], query, queryId)
+            return self.iterate(args[0], queryId, query.get("slice"))
+        # Only reads can be abandoned, writes always run to completion
+        deadline = query.get("deadline") if is_read_method(method, args) else None
+        if deadline and time() > deadline:
+            return self.returnError("Query timed out before being processed", query["method"], queryId)
+        # Pooled workers only open a corpus' traph when bound to it
+        if method == "bind":
+            try:
+                self.factory.bind(*args, **kwargs)
+            except Exception as e:
+                return self.returnError("Could not bind traph worker: %s" % str(e), query["method"], queryId)
+            return self.returnResult(True, query["method"], queryId)
+        if not self.factory.traph:
+            return self.returnError("No corpus bound to this traph worker yet", query["method"], queryId)
+        # Replicas reopen the traph files to see the primary's latest writes
+        if method == "reopen":
+            self.iterators = {}
+            try:
+                self.factory.reopen(*args, **kwargs)
+            except Exception as e:
+                return self.returnError("Could not reopen traph: %s" % str(e), query["method"], queryId)
+            return self.returnResult(True, query["method"], queryId)
+        if self.factory.readonly and method not in ["iterate_previous_query", "cancel_iterator"] and not is_read_method(query["method"], args):
+            return self.returnError("Read-only traph replica cannot run %s" % query["method"], query["method"], queryId)
+        if method == "multi":
+            if not args or not isinstance(args[0], list):
+                return self.returnError("No list of calls given.", query["method"], queryId)
+            res = self.multi(args[0], deadline)
+            self.flushWrites(method, args)
+            return self.returnResult(res, query["method"], queryId)
+        if method == "cancel_iterator":
+            if args and args[0] in self.iterators:
+                del(self.iterators[args[0]])
+            return self.returnResult(True, query["method"], queryId)
+        # Methods of the protocol enriching Traph ones come first, others
+        # are run with their iterative version whenever the Traph has one
+        if method in ["index_batch_crawl", "get_webentities_most_linked_pages"]:
+            fct = getattr(self, method)
+        else:
+            iter_method = "%s_iter" % method
+            if hasattr(Traph, iter_method):
+                method = iter_method
+            try:
+                fct = getattr(self.factory.traph, method)
+            except AttributeError as e:
+                return self.returnError("Called non existing Traph method: %s" % str(e), query, queryId)
         try:
-            res = fct(self.traph, *args, **kwargs)
+            res = fct(*args, **kwargs)
+            stream = query.get("stream")
             if type(res) == GeneratorType:
                 iteratorId = id(res)
-                self.iterators[iteratorId] = TraphIterator(iteratorId, res, query["method"])
+                self.iterators[iteratorId] = TraphIterator(iteratorId, res, query["method"], queryId, stream, deadline, query.get("slice", 0))
                 return self.iterate(iteratorId)
+            # Streamed results are sent back chunk by chunk, each one on the client's request
+            if stream:
+                chunks = chunk_result(res, stream)
+                iteratorId = id(chunks)
+                self.iterators[iteratorId] = TraphIterator(iteratorId, None, query["method"], queryId, stream, deadline)
+                self.iterators[iteratorId].chunks = chunks
+                return self.returnChunk(self.iterators[iteratorId])
         except TraphException as e:
-            return self.returnError("Traph raised: %s" % str(e), query)
+            return self.returnError("Traph raised: %s" % str(e), query, queryId)
         except Exception as e:
-            return self.returnError(str(e), query)
-        return self.returnResult(res, query["method"])
-
-    def lineLengthExceeded(self, line):
-        print >> sys.stderr, "WARNING line length exceeded server side %s (max %s)" % (len(line), self.MAX_LENGTH)
+            return self.returnError(str(e), query, queryId)
+        self.flushWrites(method)
+        return self.returnResult(res, query["method"], queryId)
 
 
 class TraphServerFactory(Factory):
@@ -121,35 +332,65 @@ class TraphServerFactory(Factory):
       's:http|h:com|h:world|': '(s:[a-zA-Z]+\\|(t:[0-9]+\\|)?(h:[^\\|]+\\|(h:[^\\|]+\\|)+|h:(localhost|(\\d{1,3}\\.){3}\\d{1,3}|\\[[\\da-f]*:[\\da-f:]*\\])\\|)(p:[^\\|]+\\|){1})'
     }
 
-    def __init__(self, corpus, traph_dir="traph-data", default_WECR=None, WECRs=None):
+    def __init__(self, corpus=None, traph_dir="traph-data", default_WECR=None, WECRs=None, readonly=False):
+        self.corpus = None
+        self.traph = None
+        self.readonly = readonly
+        if corpus:
+            self.bind(corpus, traph_dir, default_WECR, WECRs)
+
+    def bind(self, corpus, traph_dir="traph-data", default_WECR=None, WECRs=None):
+        if self.traph:
+            raise Exception("Traph worker already bound to corpus %s" % self.corpus)
         self.traph_dir = traph_dir
         self.corpus = corpus
+        self.default_WECR = default_WECR or self.default_WECR
+        self.WECRs = WECRs or self.WECRs
         if not os.path.isdir(self.traph_dir):
             os.makedirs(self.traph_dir)
+        self.open()
+
+    def open(self):
         self.traph = Traph(
-          folder=os.path.join(self.traph_dir, corpus),
-          default_webentity_creation_rule=default_WECR or self.default_WECR,
-          webentity_creation_rules=WECRs or self.WECRs
+          folder=os.path.join(self.traph_dir, self.corpus),
+          default_webentity_creation_rule=self.default_WECR,
+          webentity_creation_rules=self.WECRs
         )
 
+    def flush(self):
+        for f in [self.traph.lru_trie_file, self.traph.link_store_file]:
+            if f and not f.closed:
+                f.flush()
+
+    def reopen(self, WECRs=None):
+        # Replicas get the creation rules added or removed on the primary
+        if WECRs is not None:
+            self.WECRs = WECRs
+        self.traph.close()
+        self.open()
+
     def ready(self):
         # stdin message received by childprocess to know when traph is ready
         print "READY"
 
     def buildProtocol(self, addr):
-        return TraphProtocol(self.traph)
+        return TraphProtocol(self)
 
     def close(self):
-        self.traph.close()
+        if self.traph:
+            self.traph.close()
 
 if __name__ == "__main__":
     sock = sys.argv[1]
-    corpus = sys.argv[2]
-    try:
-        with open(sock+"-options.json") as f:
-            options = json.load(f)
-    except:
-        options = {}
+    # Without a corpus, start as a pooled worker waiting to be bound to one
+    corpus = sys.argv[2] if len(sys.argv) > 2 else None
+    options = {}
+    if corpus:
+        try:
+            with open(sock+"-options.json") as f:
+                options = json.load(f)
+        except:
+            pass
     traph = TraphServerFactory(corpus, **options)
     endpoint = UNIXServerEndpoint(reactor, sock)
     server_listening_deferred = endpoint.listen(traph)